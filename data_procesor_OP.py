@@ -6,16 +6,36 @@ import chess.pgn
 from pathlib import Path
 import os
 import io
+import json
 import logging
 import sys
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing as mp
-from datetime import datetime
+import queue
+import heapq
+import time
+from datetime import datetime, timedelta
 import re
 
+from src.conversor.board_representation import PlaneArena, resolve_feature_set, FEATURE_SETS
+from src.conversor.plane_packing import PACKED_FORMAT, pack_planes, num_positions
+from src.conversor.position_cache import PositionCache
+from src.conversor.shards import (
+    ShardWriter, SHARD_SIZE, FILE_KEYS, UCI_DTYPE, add_shard_weights, manifest_sources, merge_arrays,
+)
+from src.conversor.dedup import dedup_records, update_dedup_index
+from src.conversor.shm_ring import SharedRing
+from src.conversor.stage_metrics import stage, record, start_run, load_run, summarize, save_summary, format_summary
+from src.conversor.pgn_stream import (
+    load_game_index, iter_game_texts, select_games, find_pgn_files, HeaderFilter, MainlineVisitor
+)
+from src.conversor.compressed_pgn import compression_of, known_seek_points, open_pgn, pgn_stem
+from src.move_encoding import uci_array_to_squares, moves_to_indices, pack_moves
+
 # === CONFIGURACIÓN DE LOGGING ===
 LOGS_DIR = "logs"
 LOG_FILE = Path(LOGS_DIR) / "processing.log"
+METRICS_FILE = Path(LOGS_DIR) / "processing_metrics.jsonl"  # Tiempos y contadores por etapa (una línea JSON cada uno)
 
 # Crear directorio de logs
 Path(LOGS_DIR).mkdir(exist_ok=True)
@@ -32,139 +52,76 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def fen_to_8x8x29(fen: str, last_moves: list = None):
-    """
-    Convierte un FEN a un array 8x8x29.
-    Cada plano representa una característica del tablero.
-    """
-    if last_moves is None:
-        last_moves = []
-    
-    board = chess.Board(fen)
-    planes = np.zeros((8, 8, 29), dtype=np.float32)
-    piece_to_index = {'P': 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4, 'K': 5}
-    
-    # 0-11: Piezas (blancas 0-5, negras 6-11)
-    for i in range(8):
-        for j in range(8):
-            sq = chess.square(j, 7 - i)
-            piece = board.piece_at(sq)
-            if piece:
-                idx = piece_to_index[piece.symbol().upper()]
-                if piece.color == chess.WHITE:
-                    planes[i, j, idx] = 1
-                else:
-                    planes[i, j, idx + 6] = 1
-    
-    # 12: Turno (1 si es blanco)
-    if board.turn == chess.WHITE:
-        planes[:, :, 12] = 1
-    
-    # 13-16: Enroque
-    if board.has_kingside_castling_rights(chess.WHITE): planes[:, :, 13] = 1
-    if board.has_queenside_castling_rights(chess.WHITE): planes[:, :, 14] = 1
-    if board.has_kingside_castling_rights(chess.BLACK): planes[:, :, 15] = 1
-    if board.has_queenside_castling_rights(chess.BLACK): planes[:, :, 16] = 1
-    
-    # 17: Al paso
-    if board.ep_square:
-        file = chess.square_file(board.ep_square)
-        rank = 7 - chess.square_rank(board.ep_square)
-        planes[rank, file, 17] = 1
-    
-    # 18: Jaque
-    if board.is_check():
-        planes[:, :, 18] = 1
-    
-    # 19: 50 movimientos sin progreso
-    planes[:, :, 19] = 1 if board.halfmove_clock >= 50 else 0
-    
-    # 20-21: Últimos 2 movimientos
-    recent_moves = last_moves[-2:]
-    for k, move_uci in enumerate(recent_moves):
-        try:
-            move = chess.Move.from_uci(move_uci)
-            fr = move.from_square
-            to = move.to_square
-            i_fr, j_fr = 7 - chess.square_rank(fr), chess.square_file(fr)
-            i_to, j_to = 7 - chess.square_rank(to), chess.square_file(to)
-            planes[i_fr, j_fr, 20 + k] = 1
-            planes[i_to, j_to, 20 + k] = 1
-        except:
-            pass
-    
-    # 22: Distancia del rey blanco al centro
-    w_king = board.king(chess.WHITE)
-    if w_king:
-        dist = ((chess.square_file(w_king) - 3.5)**2 + (7 - chess.square_rank(w_king) - 3.5)**2)**0.5
-        planes[:, :, 22] = dist / 6
-    
-    # 23: Distancia del rey negro al centro
-    b_king = board.king(chess.BLACK)
-    if b_king:
-        dist = ((chess.square_file(b_king) - 3.5)**2 + (7 - chess.square_rank(b_king) - 3.5)**2)**0.5
-        planes[:, :, 23] = dist / 6
-    
-    # 24: Control del centro (d4, d5, e4, e5)
-    center = [chess.D4, chess.D5, chess.E4, chess.E5]
-    for sq in center:
-        i, j = 7 - chess.square_rank(sq), chess.square_file(sq)
-        attackers = len(board.attackers(chess.WHITE, sq)) - len(board.attackers(chess.BLACK, sq))
-        planes[i, j, 24] = np.tanh(attackers / 3)
-    
-    # 25: Estructura de peones (dobles, pasados)
-    for sq in board.pieces(chess.PAWN, chess.WHITE):
-        file = chess.square_file(sq)
-        rank = chess.square_rank(sq)
-        # Peón doblado
-        if any(chess.square_file(p) == file and chess.square_rank(p) < rank for p in board.pieces(chess.PAWN, chess.WHITE)):
-            planes[7 - rank, file, 25] = 0.5
-        # Peón pasado
-        is_passed = True
-        for f in [file-1, file, file+1]:
-            if 0 <= f <= 7:
-                for r in range(rank+1, 8):
-                    if board.piece_at(chess.square(f, r)) and board.piece_at(chess.square(f, r)).piece_type == chess.PAWN and board.piece_at(chess.square(f, r)).color == chess.BLACK:
-                        is_passed = False
-        if is_passed:
-            planes[7 - rank, file, 25] = 1.0
-    
-    # 26: Piezas desarrolladas (N y B fuera de la fila inicial)
-    for sq in board.pieces(chess.KNIGHT, chess.WHITE):
-        if chess.square_rank(sq) > 1:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.BISHOP, chess.WHITE):
-        if chess.square_rank(sq) > 1:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.KNIGHT, chess.BLACK):
-        if chess.square_rank(sq) < 6:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.BISHOP, chess.BLACK):
-        if chess.square_rank(sq) < 6:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    
-    # 27: Mapa de ataques
-    for i in range(8):
-        for j in range(8):
-            sq = chess.square(j, 7 - i)
-            diff = len(board.attackers(chess.WHITE, sq)) - len(board.attackers(chess.BLACK, sq))
-            planes[i, j, 27] = np.tanh(diff / 5)
-    
-    # 28: Movilidad (número de movimientos legales por casilla)
-    mobility = np.zeros((8, 8))
-    for move in board.legal_moves:
-        to_sq = move.to_square
-        i_to, j_to = 7 - chess.square_rank(to_sq), chess.square_file(to_sq)
-        mobility[i_to, j_to] += 1
-    planes[:, :, 28] = np.tanh(mobility / 10)
-    
-    return planes
-
 # === CONFIGURACIÓN GENERAL ===
-RAW_DATA_DIR = "notebooks/data/raw"
+RAW_DATA_DIR = "notebooks/data/raw"  # .pgn, o comprimidos .pgn.zst / .pgn.bz2 / .pgn.gz (se leen sin descomprimir a disco)
 PROCESSED_DIR = "data/processed"
 PROCESSED_LOG_FILE = Path(LOGS_DIR) / "processed_files.txt"
+PGN_INDEX_DIR = "data/pgn_index"  # Índices de partidas (byte de inicio de cada una) de cada PGN
+PARTS_DIR = Path(PROCESSED_DIR) / "parts"  # Partes de los PGN troceados, hasta que terminan todas
+SPLIT_MIN_MB = 64     # Los PGN más grandes se parten en trozos (descomprimidos, en los .zst/.bz2/.gz)
+SPLIT_CHUNK_MB = 32   # Tamaño aproximado de cada trozo: limita la memoria de cada worker
+PGN_MB_PER_SEC = 1.5  # Ritmo estimado de un worker (MB de PGN por segundo) para prever la hora de fin
+# La salida final son shards de SHARD_SIZE posiciones por tipo de partida (ver src/conversor/shards.py)
+SHARD_LAYOUT = "npy"  # "npy": carpeta de .npy sin comprimir (mmap en entrenamiento) | "npz": comprimido
 MAX_WORKERS = max(1, mp.cpu_count() - 4)
+PACKED_OUTPUT = True  # Guardar los planos en formato compacto (bitboards) en vez de float32
+FEATURE_SET = "full-29"  # Conjunto de planos a codificar ("full-29", "core-22", "cheap-25" o lista)
+FEATURE_PLANES = resolve_feature_set(FEATURE_SET)
+PLANE_DTYPE = "float32"  # Tipo de X si no se empaqueta: "float32", "float16" o "uint8" (cuantizado)
+POSITION_CACHE_SIZE = 20000     # Posiciones en la caché LRU de cada worker (0 = sin caché, ~7 KB cada una)
+POSITION_CACHE_MAX_PLY = 20     # Solo se cachean las primeras medias jugadas (aperturas)
+PGN_BYTES_PER_POSITION = 12     # Estimación para reservar el arena de cada rango (~10 sin comentarios, ~25 con [%clk])
+CANONICAL = False  # Codificar desde el lado que mueve: con negras al turno se refleja tablero y jugada
+DEDUP = False      # Unir posiciones repetidas (hash Zobrist + jugada) en un registro con peso al hacer los shards,
+                   # también con las de shards anteriores (índice dedup_index.npy junto al manifiesto)
+
+# === MODO PIPELINE (etapas separadas unidas por memoria compartida) ===
+# Los codificadores dejan las posiciones en un anillo de memoria compartida y
+# los escritores las comprimen y guardan: la compresión (zlib, un solo hilo)
+# no para la codificación y cada etapa tiene su propio número de procesos.
+PIPELINE = False
+PIPELINE_WRITERS = max(1, MAX_WORKERS // 4)                # Procesos que comprimen y escriben los .npz
+PIPELINE_ENCODERS = max(1, MAX_WORKERS - PIPELINE_WRITERS)  # Procesos que parsean y codifican
+PIPELINE_SLOTS = 16      # Huecos del anillo (limita lo que los codificadores se adelantan)
+PIPELINE_SLOT_MB = 16    # Tamaño de cada hueco (~58.000 posiciones empaquetadas)
+
+# === FILTROS POR CABECERA (se aplican antes de parsear cada partida; None = sin filtro) ===
+MIN_ELO = None                 # Elo mínimo de ambos jugadores, p. ej. 2200
+SPEEDS = None                  # Ritmos admitidos, p. ej. {"blitz", "rapid"}
+RESULTS = None                 # Resultados admitidos, p. ej. {"1-0", "0-1"} (solo decisivas)
+EXCLUDED_TERMINATIONS = set()  # Terminaciones descartadas, p. ej. {"Abandoned", "Rules infraction"}
+HEADER_FILTER = HeaderFilter(MIN_ELO, SPEEDS, RESULTS, EXCLUDED_TERMINATIONS)
+
+# Caché de posiciones y arena de planos del proceso (cada worker crea los suyos)
+_position_cache = None
+_plane_arena = None
+_pgn_sizes = {}  # PGN → bytes de texto (ver pgn_size)
+
+
+def get_position_cache():
+    """Caché de posiciones compartida por todas las partidas del proceso, o None."""
+    global _position_cache
+    if _position_cache is None and POSITION_CACHE_SIZE > 0:
+        _position_cache = PositionCache(POSITION_CACHE_SIZE, max_ply=POSITION_CACHE_MAX_PLY)
+    return _position_cache
+
+
+def get_plane_arena(pgn_bytes: int) -> PlaneArena:
+    """
+    Arena de planos del proceso, vacío y con sitio para las posiciones
+    estimadas en `pgn_bytes` de PGN. Se reutiliza de un rango al siguiente
+    (solo crece), así que lo que devuelve encode_game_range sin empaquetar
+    vale hasta la siguiente llamada.
+    """
+    global _plane_arena
+    packed = PACKED_OUTPUT and FEATURE_PLANES == FEATURE_SETS["full-29"]
+    capacity = pgn_bytes // PGN_BYTES_PER_POSITION + 1
+    if _plane_arena is None:
+        _plane_arena = PlaneArena(capacity, num_planes=len(FEATURE_PLANES), dtype=np.float32 if packed else PLANE_DTYPE)
+    else:
+        _plane_arena.reset(capacity)
+    return _plane_arena
+
 
 # Patrón para extraer: jugador_tipo_año.pgn
 PATTERN = re.compile(r'(?P<player>[\w\-]+)_(?P<time_control>\w+)_\d{4}')
@@ -172,7 +129,7 @@ PATTERN = re.compile(r'(?P<player>[\w\-]+)_(?P<time_control>\w+)_\d{4}')
 def get_metadata_from_filename(filename: str):
     """Extrae jugador y tipo de partida del nombre del archivo.
     El tipo de partida es lo que está después del último '_', antes de '.pgn'."""
-    name = Path(filename).stem  # Quita .pgn
+    name = pgn_stem(filename)  # Quita .pgn (y .zst, .bz2 o .gz)
     if '_' not in name:
         return "unknown", "unknown"
     
@@ -184,89 +141,175 @@ def get_metadata_from_filename(filename: str):
         return player, time_control
     return "unknown", "unknown"
 
-def process_single_game(game_content: str):
-    X_local = []
-    y_local = []
+def process_single_game(game_content: str, arena: PlaneArena) -> MainlineVisitor:
+    """
+    Codifica todas las posiciones de una partida directamente en `arena`
+    mientras se lee la línea principal (MainlineVisitor: sin árbol de
+    nodos, variantes ni comentarios), actualizando los planos movimiento a
+    movimiento con GameEncoder.
+    Devuelve el visitor: `moves` son los movimientos UCI jugados en esas
+    posiciones (reflejados con negras al turno si CANONICAL), `hashes` sus
+    hashes Zobrist si DEDUP y `encode_seconds` el tiempo de codificación.
+    """
+    visitor = MainlineVisitor(arena, feature_set=FEATURE_PLANES, cache=get_position_cache(), canonical=CANONICAL,
+                              hashes=DEDUP)
     try:
-        game = chess.pgn.read_game(io.StringIO(game_content))
-        if game is None:
-            return [], []
-        board = game.board()
-        move_history = []
-        for move in game.mainline_moves():
-            try:
-                fen = board.fen()
-                uci_move = move.uci()
-                if len(fen) < 10 or '[]' in fen:
-                    board.push(move)
-                    move_history.append(uci_move)
-                    continue
-                board_array = fen_to_8x8x29(fen, last_moves=move_history[-2:])
-                X_local.append(board_array)
-                y_local.append(uci_move)
-            except Exception:
-                pass
-            board.push(move)
-            move_history.append(uci_move)
+        chess.pgn.read_game(io.StringIO(game_content), Visitor=lambda: visitor)
     except Exception:
         pass
-    return X_local, y_local
+    return visitor
 
-def process_pgn_file(args):
-    pgn_path, processed_log = args
-    X_batch = []
+def game_index(pgn_path: Path) -> np.ndarray:
+    """load_game_index en PGN_INDEX_DIR (la etapa "index" se anota solo al construirlo)."""
+    return load_game_index(pgn_path, PGN_INDEX_DIR)
+
+
+def pgn_size(pgn_path: Path) -> int:
+    """
+    Bytes de texto PGN: el tamaño del archivo, o el descomprimido (del
+    índice) si está comprimido. Se calcula una vez por archivo y proceso.
+    """
+    if pgn_path not in _pgn_sizes:
+        _pgn_sizes[pgn_path] = int(game_index(pgn_path)[-1]) if compression_of(pgn_path) else pgn_path.stat().st_size
+    return _pgn_sizes[pgn_path]
+
+
+def move_labels(moves) -> dict:
+    """
+    Etiquetas de las jugadas UCI, calculadas una sola vez en la ingesta:
+    y (UCI como bytes de ancho fijo, sin objetos), policy (índice 0-4671
+    en int16, -1 si no es codificable) y move (from | to << 6 | promo << 12
+    en uint16, ver pack_moves).
+    """
+    y = np.asarray(moves).astype(UCI_DTYPE)
+    squares = uci_array_to_squares(y)
+    return dict(y=y, policy=moves_to_indices(*squares), move=pack_moves(*squares))
+
+
+def encode_game_range(pgn_path: Path, offsets, start: int = 0, stop: int = None, readers=None):
+    """
+    Codifica las partidas [start, stop) del PGN y devuelve el diccionario de
+    arrays a guardar (vacío si no hay posiciones) y el número de partidas
+    leídas (las que pasan HEADER_FILTER). Sin empaquetar, X es una vista
+    del arena del proceso (ver get_plane_arena). `readers` son dos open_pgn
+    (cabeceras, partidas) compartidos por los rangos seguidos de una lectura
+    (ver process_pgn_parts); sin ellos se abre el PGN para este rango.
+    """
+    header_reader, text_reader = readers or (None, None)
+    packed = PACKED_OUTPUT and FEATURE_PLANES == FEATURE_SETS["full-29"]
     y_batch = []
+    hashes = [] if DEDUP else None
+    num_games = 0
+    games = None
+    stop = len(offsets) - 1 if stop is None else stop
+    task = f"{pgn_path.name}[{start}:{stop}]"
+    if HEADER_FILTER.active:
+        # Primera pasada solo por las cabeceras: las partidas descartadas no se parsean
+        with stage("filter", task, games=stop - start):
+            games = select_games(pgn_path, HEADER_FILTER, offsets, start, stop, handle=header_reader)
+        logger.info(f"🔎 {pgn_path.name} [{start}-{stop}]: {len(games)}/{stop - start} partidas pasan el filtro de cabeceras")
+    bytes_in = int(offsets[stop] - offsets[start]) if games is None else int((offsets[games + 1] - offsets[games]).sum())
+    arena = get_plane_arena(bytes_in)
+
+    # El visitor mide lo que tarda en codificar; el resto del bucle es lectura y parseo
+    loop_start = time.perf_counter()
+    encode_seconds = 0.0
+    for _, game_str in iter_game_texts(pgn_path, offsets, start, stop, games=games, handle=text_reader):
+        visitor = process_single_game(game_str, arena)
+        y_batch.extend(visitor.moves)
+        if hashes is not None:
+            hashes.extend(visitor.hashes)
+        encode_seconds += visitor.encode_seconds
+        num_games += 1
+    loop_seconds = time.perf_counter() - loop_start
+    record("parse", loop_seconds - encode_seconds, task, games=num_games, bytes_in=bytes_in)
+    record("encode", encode_seconds, task, games=num_games, positions=len(y_batch))
+    if not y_batch:
+        return {}, num_games
+
+    with stage("pack", task, positions=len(y_batch)) as counters:
+        X_array = arena.view()
+        counters["bytes_in"] = X_array.nbytes
+        if packed:
+            arrays = dict(format=np.array(PACKED_FORMAT), canonical=np.array(CANONICAL), **pack_planes(X_array))
+        else:
+            # El formato compacto solo existe para los 29 planos en float32; se guarda qué planos lleva X
+            arrays = dict(X=X_array, planes=np.array(FEATURE_PLANES, dtype=np.int8), canonical=np.array(CANONICAL))
+        arrays.update(move_labels(y_batch))
+        if hashes is not None:
+            arrays["zobrist"] = np.array(hashes, dtype=np.uint64)
+        counters["bytes_out"] = sum(value.nbytes for value in arrays.values())
+    return arrays, num_games
+
+
+def save_processed(temp_file: Path, arrays: dict) -> bool:
+    """Guarda el .npz de un PGN y comprueba que se puede leer; lo borra si está corrupto."""
+    with stage("compress", temp_file.name, positions=len(arrays["y"])) as counters:
+        counters["bytes_in"] = sum(value.nbytes for value in arrays.values())
+        np.savez_compressed(temp_file, **arrays)
+        counters["bytes_out"] = temp_file.stat().st_size
+    npz_size = temp_file.stat().st_size / (1024 * 1024)  # en MB
+    unencodable = int((arrays["policy"] < 0).sum())
+    logger.info(f"✅ Guardado: {temp_file.name} | Posiciones: {len(arrays['y'])} | "
+                f"No codificables: {unencodable} | Tamaño: {npz_size:.2f} MB")
+    try:
+        with stage("validate", temp_file.name, bytes_in=temp_file.stat().st_size, positions=len(arrays["y"])):
+            test_load = np.load(temp_file)  # sin allow_pickle: no debe haber arrays de objetos
+            assert ('X' in test_load or 'bitboards' in test_load) and 'y' in test_load
+            assert num_positions(test_load) == len(test_load['y']) == len(test_load['policy'])
+            test_load.close()
+        logger.info(f"✅ Validación exitosa: {temp_file.name}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Guardado corrupto: {temp_file.name} → {e}")
+        temp_file.unlink()  # borrar si está corrupto
+        return False
+
+
+def log_cache_stats():
+    cache = get_position_cache()
+    if cache is not None:
+        stats = cache.stats()
+        logger.info(f"🗃️  Caché de posiciones (worker {os.getpid()}): {stats['hit_rate']:.1%} aciertos | "
+                    f"{stats['hits']:,} aciertos / {stats['misses']:,} fallos | {stats['entries']:,} entradas")
+
+
+def process_pgn_file(args):
+    pgn_path, already_logged = args
 
     # Extraer metadatos
     filename = pgn_path.name
     player, time_control = get_metadata_from_filename(filename)
 
     # Verificar si ya existe el .npz
-    temp_file = Path(PROCESSED_DIR) / f"temp_{pgn_path.stem}.npz"
+    temp_file = Path(PROCESSED_DIR) / f"temp_{pgn_stem(pgn_path)}.npz"
     if temp_file.exists():
         logger.warning(f"⚠️  Saltado (archivo .npz ya existe): {filename} | {player} | {time_control}")
         return 0, player, time_control, 0, pgn_path.stat().st_size
 
     # Verificar si ya está en el log
-    if filename in processed_log:
+    if already_logged:
         logger.warning(f"⚠️  Saltado (registrado en log): {filename} | {player} | {time_control}")
         return 0, player, time_control, 0, pgn_path.stat().st_size
 
     try:
         file_size = pgn_path.stat().st_size / (1024 * 1024)  # MB
-        with open(pgn_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        games = [g for g in content.strip().split("\n\n\n") if g.strip()]
-        num_games = len(games)
+        # Las partidas se leen de una en una por su rango de bytes, sin cargar el archivo
+        offsets = game_index(pgn_path)
+        num_games = len(offsets) - 1
 
         logger.info(f"📄 Procesando: {filename} | Jugador: {player} | Tipo: {time_control} | Partidas: {num_games} | Tamaño: {file_size:.2f} MB")
 
-        for game_str in games:
-            X_game, y_game = process_single_game(game_str)
-            X_batch.extend(X_game)
-            y_batch.extend(y_game)
-
-        if X_batch and y_batch:
-            X_array = np.array(X_batch, dtype=np.float32)
-            y_array = np.array(y_batch, dtype=object)
-            np.savez_compressed(temp_file, X=X_array, y=y_array)
-            npz_size = temp_file.stat().st_size / (1024 * 1024)  # en MB
-            logger.info(f"✅ Guardado: {temp_file.name} | Posiciones: {len(X_array)} | Tamaño: {npz_size:.2f} MB")
-            try:
-                test_load = np.load(temp_file, allow_pickle=True)
-                assert 'X' in test_load and 'y' in test_load
-                assert len(test_load['X']) == len(test_load['y'])
-                test_load.close()
-                logger.info(f"✅ Validación exitosa: {temp_file.name}")
-            except Exception as e:
-                logger.error(f"❌ Guardado corrupto: {temp_file.name} → {e}")
-                temp_file.unlink()  # borrar si está corrupto
+        arrays, num_games = encode_game_range(pgn_path, offsets)
+        if arrays:
+            log_cache_stats()
+            if not save_processed(temp_file, arrays):
                 return 0, player, time_control, 0, 0
             # Registrar en log
             with open(PROCESSED_LOG_FILE, "a", encoding='utf-8') as log_f:
                 log_f.write(f"{filename}\n")
 
-            return len(X_array), player, time_control, num_games, file_size
+            return len(arrays['y']), player, time_control, num_games, file_size
 
         else:
             logger.warning(f"⚠️  Sin datos útiles: {filename}")
@@ -276,15 +319,512 @@ def process_pgn_file(args):
         logger.error(f"❌ Error grave con {filename}: {e}")
         return 0, player, time_control, 0, 0
 
+
+# === Reparto de PGN grandes entre varios workers ===
+def split_game_ranges(offsets, num_chunks: int) -> list:
+    """
+    Parte las partidas en `num_chunks` rangos [start, stop) contiguos con
+    aproximadamente los mismos bytes (y por tanto movimientos) cada uno.
+    """
+    num_games = len(offsets) - 1
+    total = offsets[-1] - offsets[0]
+    targets = offsets[0] + total * np.arange(1, num_chunks) / num_chunks
+    cuts = np.searchsorted(offsets[:-1], targets)
+    bounds = sorted({0, num_games, *(int(c) for c in cuts)})
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def plan_file_tasks(pgn_path: Path) -> list:
+    """
+    Lecturas en que se procesa un PGN: listas de rangos de partidas
+    [start, stop) seguidos que un mismo worker lee de principio a fin,
+    guardando cada rango como una parte. Uno solo si es pequeño; si pasa de
+    SPLIT_MIN_MB, rangos de ~SPLIT_CHUNK_MB, así que la memoria no crece
+    con el tamaño del PGN (un volcado mensual comprimido pasa de 100 GB
+    descomprimido). Puede haber muchos más trozos que workers: el pool los
+    va encolando.
+
+    Un PGN sin comprimir se lee a saltos, así que cada rango es una lectura.
+    Un comprimido solo se puede empezar a leer en sus puntos de acceso (ver
+    compressed_pgn): cada lectura empieza en la primera partida tras uno y
+    junta frames hasta ~SPLIT_CHUNK_MB. Con un solo frame (lo habitual en
+    los .zst de Lichess) todo el archivo es una lectura seguida: repartirlo
+    obligaría a cada worker a descomprimir desde el principio hasta su rango.
+    """
+    size = pgn_size(pgn_path)
+    if size < SPLIT_MIN_MB * 1024 * 1024:
+        return [[(0, None)]]
+    offsets = game_index(pgn_path)
+    chunk_bytes = SPLIT_CHUNK_MB * 1024 * 1024
+    if not compression_of(pgn_path):
+        return [[r] for r in split_game_ranges(offsets, int(np.ceil(size / chunk_bytes)))]
+
+    num_games = len(offsets) - 1
+    firsts = np.searchsorted(offsets[:-1], [position for _, position in known_seek_points(pgn_path)])
+    bounds = sorted({0, num_games, *(int(g) for g in firsts if 0 < g < num_games)})
+    runs, run_start = [], 0
+    for bound in bounds[1:]:
+        if offsets[bound] - offsets[run_start] >= chunk_bytes or bound == num_games:
+            run = offsets[run_start:bound + 1]
+            ranges = split_game_ranges(run, int(np.ceil((run[-1] - run[0]) / chunk_bytes)))
+            runs.append([(run_start + a, run_start + b) for a, b in ranges])
+            run_start = bound
+    return runs
+
+
+def part_temp_name(pgn_path: Path, part: int, num_parts: int) -> str:
+    """temp_<PGN>.npz si el PGN va entero; temp_<PGN>.partNNN.npz si va por partes."""
+    stem = pgn_stem(pgn_path)
+    return f"temp_{stem}.npz" if num_parts == 1 else f"temp_{stem}.part{part:03d}.npz"
+
+
+def source_pgn(source: str) -> str:
+    """PGN (sin extensión) de un origen del manifiesto o de un temp_*.npz: quita el ".partNNN"."""
+    return re.sub(r"\.part\d+$", "", source)
+
+
+def part_marker(pgn_path: Path, part: int, num_parts: int) -> Path:
+    """Marca de parte terminada en PARTS_DIR: el .json de al lado de su temp_*.npz."""
+    return PARTS_DIR / (part_temp_name(pgn_path, part, num_parts)[:-len(".npz")] + ".json")
+
+
+def save_pgn_part(pgn_path: Path, part: int, num_parts: int, start: int, stop, num_games: int, arrays: dict) -> bool:
+    """
+    Guarda (comprimida y validada) una parte de un PGN en PARTS_DIR, donde
+    espera a que terminen las demás, y después su marca de terminada con el
+    rango, las partidas y las posiciones (también si no tiene posiciones).
+    Las partes con marca sobreviven a una ejecución interrumpida (ver
+    resume_parts). Devuelve False si la parte salió corrupta.
+    """
+    if arrays and not save_processed(PARTS_DIR / part_temp_name(pgn_path, part, num_parts), arrays):
+        return False
+    marker = part_marker(pgn_path, part, num_parts)
+    tmp = marker.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"start": start, "stop": stop, "num_parts": num_parts, "pgn_bytes": pgn_size(pgn_path),
+                   "games": num_games, "positions": len(arrays["y"]) if arrays else 0}, f)
+    os.replace(tmp, marker)
+    return True
+
+
+def process_pgn_parts(args):
+    """
+    Codifica una lectura de schedule_tasks (rangos de un PGN grande, en
+    orden) con los mismos archivos abiertos de principio a fin y guarda cada
+    rango como parte en PARTS_DIR; publish_pgn_parts las publica. Si una
+    falla se deja la lectura ahí: las que falten se reintentan en la
+    siguiente ejecución.
+    """
+    pgn_path, parts, num_parts = args
+    part = parts[0][0]
+    try:
+        offsets = game_index(pgn_path)
+        with open_pgn(pgn_path) as headers, open_pgn(pgn_path) as texts:
+            for part, start, stop in parts:
+                arrays, num_games = encode_game_range(pgn_path, offsets, start, stop, readers=(headers, texts))
+                logger.info(f"🧩 Parte {part} de {pgn_path.name}: partidas {start}-{stop} | Posiciones: {len(arrays.get('y', []))}")
+                if not save_pgn_part(pgn_path, part, num_parts, start, stop, num_games, arrays):
+                    break
+    except Exception as e:
+        logger.error(f"❌ Error en la parte {part} de {pgn_path.name}: {e}")
+    log_cache_stats()
+
+
+def resume_parts(tasks: list) -> dict:
+    """
+    Partes terminadas en ejecuciones anteriores que siguen valiendo: las de
+    los PGN de `tasks` ([(ruta, lecturas)], ver plan_file_tasks) cuya marca
+    coincide con el plan actual (rango, número de partes y tamaño del PGN)
+    y cuyo .npz se puede abrir. Borra de PARTS_DIR todo lo demás (partes
+    a medio escribir, de otro plan o de PGN que ya no se procesan).
+    Devuelve {ruta: {parte: marca}}.
+    """
+    plans = {}
+    for pgn_path, runs in tasks:
+        ranges = [r for run in runs for r in run]
+        plans[pgn_stem(pgn_path)] = (pgn_path, ranges)
+    resumed, keep = {}, set()
+    for marker in sorted(PARTS_DIR.glob("temp_*.json")):
+        stem = source_pgn(marker.stem[len("temp_"):])
+        if stem not in plans:
+            continue
+        pgn_path, ranges = plans[stem]
+        match = re.search(r"\.part(\d+)$", marker.stem)
+        part = int(match.group(1)) if match else 0
+        try:
+            with open(marker, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            valid = (info["num_parts"] == len(ranges) and part < len(ranges)
+                     and (info["start"], info["stop"]) == tuple(ranges[part])
+                     and info["pgn_bytes"] == pgn_size(pgn_path)
+                     and marker.name == part_marker(pgn_path, part, len(ranges)).name)
+            part_file = marker.with_suffix(".npz")
+            if valid and info["positions"]:
+                with np.load(part_file) as data:
+                    valid = len(data["y"]) == info["positions"]
+        except (OSError, ValueError, KeyError):
+            valid = False
+        if valid:
+            resumed.setdefault(pgn_path, {})[part] = info
+            keep |= {marker.name, part_file.name}
+    for f in PARTS_DIR.glob("temp_*"):
+        if f.name not in keep:
+            f.unlink()
+    for pgn_path, done in resumed.items():
+        logger.info(f"♻️  {pgn_path.name}: {len(done)}/{len(plans[pgn_stem(pgn_path)][1])} partes ya hechas en una ejecución anterior")
+    return resumed
+
+
+def publish_pgn_parts(pgn_path: Path, num_parts: int):
+    """
+    Cuando ya no queda ninguna parte de un PGN en marcha, pasa sus
+    temp_*.npz de PARTS_DIR a PROCESSED_DIR y lo anota en el log. Las
+    partes no se unen: shard_processed_files las reparte una a una. Si
+    falta alguna (falló) no publica ni anota nada: las terminadas se quedan
+    en PARTS_DIR y la siguiente ejecución solo rehace las que faltan.
+    Devuelve lo mismo que process_pgn_file.
+    """
+    filename = pgn_path.name
+    player, time_control = get_metadata_from_filename(filename)
+    file_size = pgn_path.stat().st_size / (1024 * 1024)  # MB
+    markers = [part_marker(pgn_path, part, num_parts) for part in range(num_parts)]
+    missing = [part for part, marker in enumerate(markers) if not marker.exists()]
+    if missing:
+        logger.error(f"❌ Faltan las partes {missing} de {filename}: no se publica (se reintentarán)")
+        return 0, player, time_control, 0, 0
+    published = []
+    try:
+        infos = []
+        for marker in markers:
+            with open(marker, "r", encoding="utf-8") as f:
+                infos.append(json.load(f))
+        num_games = sum(info["games"] for info in infos)
+        positions = sum(info["positions"] for info in infos)
+        part_files = [marker.with_suffix(".npz") for marker, info in zip(markers, infos) if info["positions"]]
+        for f in part_files:
+            published.append(Path(PROCESSED_DIR) / f.name)
+            os.replace(f, published[-1])
+        for marker in markers:
+            marker.unlink()
+        if not part_files:
+            logger.warning(f"⚠️  Sin datos útiles: {filename}")
+            return 0, player, time_control, num_games, file_size
+        with open(PROCESSED_LOG_FILE, "a", encoding='utf-8') as log_f:
+            log_f.write(f"{filename}\n")
+        if num_parts > 1:
+            logger.info(f"🧷 {filename}: {len(part_files)} partes listas para los shards | Partidas: {num_games}")
+        return positions, player, time_control, num_games, file_size
+    except Exception as e:
+        logger.error(f"❌ Error grave publicando {filename}: {e}")
+        for f in published:
+            f.unlink(missing_ok=True)
+        return 0, player, time_control, 0, 0
+
+
+# === Modo pipeline: codificadores → anillo de memoria compartida → escritores ===
+def pipeline_send(ring: SharedRing, inbox, meta: tuple, arrays: dict):
+    """
+    Deja una parte codificada en el anillo, por trozos que caben en un
+    hueco, para el escritor de `inbox`. `meta` es (PGN, parte, número de
+    partes, partes de ese PGN en esta ejecución, start, stop, partidas);
+    cada mensaje añade (¿último trozo de la parte?, ¿falló la parte?).
+    """
+    if not arrays:
+        inbox.put((None, None, meta + (True, False)))
+        return
+    chunks = list(ring.split(arrays, FILE_KEYS))
+    # La espera de un hueco libre va aparte (ring_wait, no cuenta como ocupación): si crece, faltan escritores
+    put_start, waited = time.perf_counter(), 0.0
+    for i, chunk in enumerate(chunks):
+        waited += ring.put(chunk, meta + (i == len(chunks) - 1, False), inbox)
+    record("ring_put", time.perf_counter() - put_start - waited, meta[0].name, positions=len(arrays["y"]),
+           bytes_out=sum(value.nbytes for value in arrays.values()))
+    record("ring_wait", waited, meta[0].name)
+
+
+def pipeline_encoder(ring: SharedRing, tasks, writer_queues: list):
+    """
+    Etapa de codificación: toma lecturas de `tasks` (rangos de un PGN en
+    orden, ver schedule_tasks) hasta recibir None, las codifica de principio
+    a fin y manda cada rango como una parte al escritor asignado a su PGN
+    (ver pipeline_send). Si falla, marca como fallidas la parte en curso y
+    las que quedaban de la lectura.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        pgn_path, parts, num_parts, todo, writer = task
+        done = 0
+        try:
+            offsets = game_index(pgn_path)
+            with open_pgn(pgn_path) as headers, open_pgn(pgn_path) as texts:
+                for part, start, stop in parts:
+                    arrays, num_games = encode_game_range(pgn_path, offsets, start, stop, readers=(headers, texts))
+                    logger.info(f"🧩 Parte {part} de {pgn_path.name}: partidas {start}-{stop} | Posiciones: {len(arrays.get('y', []))}")
+                    pipeline_send(ring, writer_queues[writer], (pgn_path, part, num_parts, todo, start, stop, num_games),
+                                  arrays)
+                    done += 1
+        except Exception as e:
+            logger.error(f"❌ Error en la parte {parts[done][0]} de {pgn_path.name}: {e}")
+            for part, start, stop in parts[done:]:
+                writer_queues[writer].put((None, None, (pgn_path, part, num_parts, todo, start, stop, 0, True, True)))
+    log_cache_stats()
+
+
+def pipeline_writer(ring: SharedRing, inbox, results):
+    """
+    Etapa de escritura: saca los trozos del anillo (liberando el hueco
+    enseguida) y, cuando tiene una parte entera, la comprime y guarda en
+    PARTS_DIR como process_pgn_parts (las fallidas se descartan). Cuando
+    han llegado todas las partes de un PGN de esta ejecución lo publica con
+    publish_pgn_parts y manda el resultado por `results`.
+    """
+    pending = {}   # (PGN, parte) → trozos recibidos
+    finished = {}  # PGN → partes terminadas (guardadas o fallidas)
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        slot, layout, (pgn_path, part, num_parts, todo, start, stop, num_games, last, part_failed) = item
+        if slot is not None:
+            with stage("ring_take", pgn_path.name) as counters:
+                chunk = ring.take(slot, layout)
+                counters["positions"] = len(chunk["y"])
+                counters["bytes_in"] = sum(value.nbytes for value in chunk.values())
+            pending.setdefault((pgn_path, part), []).append(chunk)
+        if not last:
+            continue
+        chunks = pending.pop((pgn_path, part), [])
+        if not part_failed:
+            try:
+                save_pgn_part(pgn_path, part, num_parts, start, stop, num_games, merge_arrays(chunks) if chunks else {})
+            except Exception as e:
+                logger.error(f"❌ Error grave guardando la parte {part} de {pgn_path.name}: {e}")
+        finished[pgn_path] = finished.get(pgn_path, 0) + 1
+        if finished[pgn_path] < todo:
+            continue
+        del finished[pgn_path]
+        results.put(publish_pgn_parts(pgn_path, num_parts))
+
+
+# === Planificación: trabajos de mayor a menor ===
+def schedule_tasks(tasks: list, resumed: dict = None) -> list:
+    """
+    Convierte [(ruta, lecturas)] (ver plan_file_tasks) en la lista de
+    trabajos (ruta, [(parte, start, stop)], número de partes, bytes), uno
+    por lectura y sin las partes ya hechas de `resumed` (ver resume_parts),
+    ordenada de mayor a menor: los PGN enormes empiezan primero y los
+    pequeños rellenan los huecos del final, en vez de quedar uno grande
+    solo en la cola.
+    """
+    resumed = resumed or {}
+    jobs = []
+    for pgn_path, runs in tasks:
+        num_parts = sum(len(ranges) for ranges in runs)
+        if num_parts == 1:
+            if 0 not in resumed.get(pgn_path, {}):
+                start, stop = runs[0][0]
+                jobs.append((pgn_path, [(0, start, stop)], 1, pgn_size(pgn_path)))
+            continue
+        offsets = game_index(pgn_path)
+        done = resumed.get(pgn_path, {})
+        part = 0
+        for ranges in runs:
+            parts = [(part + i, start, stop) for i, (start, stop) in enumerate(ranges) if part + i not in done]
+            part += len(ranges)
+            if parts:
+                jobs.append((pgn_path, parts, num_parts, sum(int(offsets[b] - offsets[a]) for _, a, b in parts)))
+    return sorted(jobs, key=lambda job: job[-1], reverse=True)
+
+
+def predict_makespan(sizes: list, workers: int) -> int:
+    """Bytes del worker más cargado si cada trabajo, en orden, va al primero que queda libre."""
+    loads = [0] * max(1, workers)
+    for size in sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def run_pipeline(jobs: list) -> list:
+    """
+    Procesa los trabajos de schedule_tasks, en ese orden, con
+    PIPELINE_ENCODERS codificadores y PIPELINE_WRITERS escritores. Devuelve
+    el resultado de cada PGN como process_pgn_file.
+    """
+    ring = SharedRing(PIPELINE_SLOTS, int(PIPELINE_SLOT_MB * 1024 * 1024))
+    task_queue, results = mp.Queue(), mp.Queue()
+    writer_queues = [mp.Queue() for _ in range(PIPELINE_WRITERS)]
+    # Cada PGN entero a un escritor: el que menos bytes (descomprimidos) lleva hasta ahora
+    writer_of, writer_loads = {}, [0] * PIPELINE_WRITERS
+    todo = {}  # PGN → partes que se hacen en esta ejecución (el escritor publica al tenerlas)
+    for pgn_path, parts, _, _ in jobs:
+        todo[pgn_path] = todo.get(pgn_path, 0) + len(parts)
+    for pgn_path, parts, num_parts, _ in jobs:
+        if pgn_path not in writer_of:
+            writer_of[pgn_path] = writer = writer_loads.index(min(writer_loads))
+            writer_loads[writer] += pgn_size(pgn_path)
+        task_queue.put((pgn_path, parts, num_parts, todo[pgn_path], writer_of[pgn_path]))
+    for _ in range(PIPELINE_ENCODERS):
+        task_queue.put(None)
+
+    encoders = [mp.Process(target=pipeline_encoder, args=(ring, task_queue, writer_queues))
+                for _ in range(PIPELINE_ENCODERS)]
+    writers = [mp.Process(target=pipeline_writer, args=(ring, inbox, results)) for inbox in writer_queues]
+    file_results = []
+    try:
+        for process in encoders + writers:
+            process.start()
+        while len(file_results) < len(writer_of):
+            try:
+                file_results.append(results.get(timeout=5))
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in encoders + writers):
+                    logger.error("❌ Un proceso del pipeline terminó con error; se corta la espera")
+                    break
+        for inbox in writer_queues:
+            inbox.put(None)
+        for process in encoders + writers:
+            process.join(timeout=60)
+    finally:
+        for process in encoders + writers:
+            if process.is_alive():
+                process.terminate()
+        ring.close(unlink=True)
+    return file_results
+
+
+def run_worker_pool(jobs: list, logged: set) -> list:
+    """
+    Procesa los trabajos de schedule_tasks, en ese orden, con MAX_WORKERS
+    procesos que codifican y guardan cada uno lo suyo; los PGN partidos se
+    publican cuando terminan todas sus lecturas. A cada worker solo le llega
+    si su PGN ya está en el log (`logged`), no el log entero. Devuelve el
+    resultado de cada PGN como process_pgn_file.
+    """
+    file_results = []
+    pending_reads = {}  # PGN partido → lecturas sin terminar
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for f, parts, num_parts, _ in jobs:
+            if num_parts == 1:
+                futures[executor.submit(process_pgn_file, (f, f.name in logged))] = (f, None)
+            else:
+                futures[executor.submit(process_pgn_parts, (f, parts, num_parts))] = (f, num_parts)
+                pending_reads[f] = pending_reads.get(f, 0) + 1
+
+        for future in as_completed(futures):
+            pgn_path, num_parts = futures[future]
+            if num_parts is None:
+                file_results.append(future.result())
+                continue
+            future.result()
+            pending_reads[pgn_path] -= 1
+            if pending_reads[pgn_path] == 0:
+                file_results.append(publish_pgn_parts(pgn_path, num_parts))
+    return file_results
+
+def dedup_selections(temp_files: list, index: np.ndarray):
+    """
+    Para cada temp_*.npz, (índices de los registros que se quedan, pesos):
+    las posiciones repetidas en todos los archivos de la tanda (mismo hash
+    Zobrist y misma jugada) se quedan en su primera aparición, con el número
+    de apariciones como peso. Las que ya están en un shard anterior (en el
+    índice `index`) no se quedan: sus apariciones se devuelven aparte, como
+    (shards, filas, apariciones nuevas), para sumarlas al peso de esa fila.
+    Los archivos sin hashes se conservan enteros.
+    """
+    keys = []
+    for temp_file in temp_files:
+        with np.load(temp_file, allow_pickle=True) as data:
+            if "zobrist" in data:
+                keys.append((data["zobrist"], data["y"]))
+            else:
+                keys.append((None, data["y"]))
+    hashed = [i for i, (zobrist, _) in enumerate(keys) if zobrist is not None]
+    selections = [(np.arange(len(y)), np.ones(len(y), dtype=np.uint32)) for _, y in keys]
+    indexed, *records = dedup_records([(index["zobrist"], index["move"])] + [keys[i] for i in hashed])
+    for i, selection in zip(hashed, records):
+        selections[i] = selection
+    # Cada clave del índice cuenta una vez en su grupo: el resto son repeticiones nuevas
+    index_rows, repeats = indexed[0], indexed[1] - 1
+    hit = np.flatnonzero(repeats)
+    repeated = (index["shard"][index_rows[hit]], index["row"][index_rows[hit]], repeats[hit])
+    total = sum(len(y) for _, y in keys)
+    kept = sum(len(keep) for keep, _ in selections)
+    if total:
+        logger.info(f"🧬 Dedup: {total:,} posiciones → {kept:,} registros nuevos ({1 - kept / total:.1%} repetidas, "
+                    f"{int(repeats.sum()):,} ya en shards anteriores)")
+    return selections, repeated
+
+
+def add_repeats(manifest: dict, repeated: tuple):
+    """Suma las repeticiones de registros de shards anteriores a su peso."""
+    shards, rows, repeats = repeated
+    for shard in np.unique(shards):
+        mine = shards == shard
+        add_shard_weights(Path(PROCESSED_DIR) / manifest["shards"][shard]["path"], rows[mine], repeats[mine])
+
+
+def shard_processed_files():
+    """
+    Reparte los temp_*.npz de PROCESSED_DIR en shards de SHARD_SIZE
+    posiciones por tipo de partida, los anota en el manifiesto y los borra.
+    Se cargan de uno en uno: las partes de un PGN grande entran como
+    orígenes separados ("jugador_blitz.part003"). Con DEDUP, las posiciones
+    que ya están en shards anteriores suben el peso de esos registros en
+    lugar de repetirse. Devuelve el número de shards nuevos.
+    """
+    writer = ShardWriter(PROCESSED_DIR, SHARD_SIZE, layout=SHARD_LAYOUT)
+    already_sharded = manifest_sources(writer.manifest)
+    shards_before = len(writer.manifest["shards"])
+    temp_files = sorted(Path(PROCESSED_DIR).glob("temp_*.npz"))
+    pending = [f for f in temp_files if f.stem[len("temp_"):] not in already_sharded]
+    selections, repeated = [None] * len(pending), None
+    if DEDUP and pending:
+        with stage("dedup", "shards"):
+            index = update_dedup_index(PROCESSED_DIR, writer.manifest)
+            selections, repeated = dedup_selections(pending, index)
+    for temp_file, selection in zip(pending, selections):
+        source = temp_file.stem[len("temp_"):]  # nombre del PGN sin extensión (y parte)
+        _, time_control = get_metadata_from_filename(source_pgn(source))
+        with np.load(temp_file, allow_pickle=True) as data:
+            arrays = {key: data[key] for key in data.files}
+        if "policy" not in arrays:
+            arrays.update(move_labels(arrays["y"]))  # .npz de versiones anteriores (y como objetos)
+        if selection is not None:
+            keep, weights = selection
+            arrays = {key: value if key in FILE_KEYS else value[keep] for key, value in arrays.items()}
+            arrays["weight"] = weights
+        with stage("shard", source, bytes_in=temp_file.stat().st_size, positions=len(arrays["y"])):
+            writer.add(arrays, time_control, source)
+    with stage("shard", "flush"):
+        writer.flush()
+    if repeated is not None:
+        # Después de los shards nuevos: si se corta aquí, se pierden repeticiones, pero no se cuentan dos veces
+        with stage("dedup", "index"):
+            add_repeats(writer.manifest, repeated)
+            update_dedup_index(PROCESSED_DIR, writer.manifest)
+    # Solo se borran cuando todo está en shards y en el manifiesto
+    for temp_file in temp_files:
+        temp_file.unlink()
+    new_shards = writer.manifest["shards"][shards_before:]
+    if new_shards:
+        logger.info(f"📦 Shards nuevos: {len(new_shards)} | Posiciones: {sum(s['count'] for s in new_shards):,} | "
+                    f"Manifiesto: {Path(PROCESSED_DIR) / 'manifest.json'}")
+    return len(new_shards)
+
+
 def process_all_games():
     Path(PROCESSED_DIR).mkdir(parents=True, exist_ok=True)
+    PARTS_DIR.mkdir(parents=True, exist_ok=True)
 
     input_path = Path(RAW_DATA_DIR)
     if not input_path.exists():
         logger.critical(f"❌ Carpeta de datos crudos no encontrada: {input_path}")
         sys.exit(1)
 
-    pgn_files = list(input_path.glob("*.pgn"))
+    pgn_files = find_pgn_files(input_path)
     if not pgn_files:
         logger.critical(f"❌ No se encontraron archivos .pgn en {RAW_DATA_DIR}")
         sys.exit(1)
@@ -295,18 +835,20 @@ def process_all_games():
         with open(PROCESSED_LOG_FILE, "r", encoding='utf-8') as f:
             processed_log = {line.strip() for line in f if line.strip()}
 
-    # Contar cuántos .npz ya existen
+    # Contar cuántos .npz ya existen (sin repartir en shards todavía, o ya en el manifiesto)
     existing_npz = {f.name[5:-4] for f in Path(PROCESSED_DIR).glob("temp_*.npz")}  # quita "temp_" y ".npz"
+    existing_npz |= manifest_sources(ShardWriter(PROCESSED_DIR).manifest)
+    existing_npz = {source_pgn(source) for source in existing_npz}
 
     # Determinar qué archivos faltan
     remaining_files = []
     for f in pgn_files:
-        if f.name not in processed_log and f.stem not in existing_npz:
+        if f.name not in processed_log and pgn_stem(f) not in existing_npz:
             remaining_files.append(f)
 
     total_files = len(pgn_files)
     already_processed_by_log = len([f for f in pgn_files if f.name in processed_log])
-    already_processed_by_npz = len([f for f in pgn_files if f.stem in existing_npz])
+    already_processed_by_npz = len([f for f in pgn_files if pgn_stem(f) in existing_npz])
     to_process = len(remaining_files)
 
     # === LOG INICIAL ===
@@ -317,30 +859,74 @@ def process_all_games():
     logger.info(f"✅ Ya procesados (log):           {already_processed_by_log}")
     logger.info(f"✅ Ya procesados (archivo .npz):  {already_processed_by_npz}")
     logger.info(f"🔁 Por procesar:                  {to_process}")
-    logger.info(f"⚙️  Núcleos utilizados:            {MAX_WORKERS}")
+    if PIPELINE:
+        logger.info(f"⚙️  Pipeline:                      {PIPELINE_ENCODERS} codificadores + {PIPELINE_WRITERS} escritores")
+    else:
+        logger.info(f"⚙️  Núcleos utilizados:            {MAX_WORKERS}")
     logger.info(f"📤 Salida:                        {PROCESSED_DIR}")
     logger.info(f"📄 Log detallado:                 {LOG_FILE}")
     logger.info("-" * 80)
 
+    run_id = start_run(METRICS_FILE)
     if to_process == 0:
+        resume_parts([])  # Partes sueltas de PGN que ya no hay que procesar
+        shard_processed_files()
         logger.info("✅ Todos los archivos ya han sido procesados. Nada que hacer.")
         return
 
     total_positions = 0
     results = []
 
-    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(process_pgn_file, (f, processed_log)) for f in remaining_files]
-        for future in as_completed(futures):
-            count, player, time_control, num_games, size_mb = future.result()
-            total_positions += count
-            results.append({
-                'player': player,
-                'time_control': time_control,
-                'games': num_games,
-                'positions': count,
-                'size_mb': size_mb
-            })
+    # Los PGN grandes se parten en rangos de partidas para que no quede un solo core con la cola
+    tasks = [(f, plan_file_tasks(f)) for f in remaining_files]
+    for f, runs in tasks:
+        num_parts = sum(len(ranges) for ranges in runs)
+        if num_parts > 1:
+            sequential = f" en {len(runs)} lecturas seguidas" if len(runs) < num_parts else ""
+            logger.info(f"✂️  {f.name}: repartido en {num_parts} trozos{sequential}")
+
+    # Partes terminadas en una ejecución interrumpida: solo se rehacen las que faltan, y los PGN
+    # que ya las tienen todas (se cortó antes de publicarlos) se publican directamente
+    resumed = resume_parts(tasks)
+    file_results = [publish_pgn_parts(f, sum(len(ranges) for ranges in runs)) for f, runs in tasks
+                    if len(resumed.get(f, ())) == sum(len(ranges) for ranges in runs)]
+    jobs = schedule_tasks(tasks, resumed)
+    workers = PIPELINE_ENCODERS if PIPELINE else MAX_WORKERS
+    pool_size = PIPELINE_ENCODERS + PIPELINE_WRITERS if PIPELINE else MAX_WORKERS
+    total_mb = sum(job[-1] for job in jobs) / (1024 * 1024)
+    predicted_s = predict_makespan([job[-1] for job in jobs], workers) / (1024 * 1024) / PGN_MB_PER_SEC
+    started = datetime.now()
+    predicted_end = started + timedelta(seconds=predicted_s)
+    if jobs:
+        logger.info(f"🗓️  {len(jobs)} trabajos de mayor a menor | {total_mb:,.1f} MB | mayor: {jobs[0][0].name} "
+                    f"({jobs[0][-1] / (1024 * 1024):,.1f} MB)")
+        logger.info(f"⏱️  Fin previsto: {predicted_end:%H:%M:%S} (~{predicted_s:,.0f} s a {PGN_MB_PER_SEC} MB/s por worker)")
+        file_results += run_pipeline(jobs) if PIPELINE else run_worker_pool(jobs, processed_log)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    measured = PGN_MB_PER_SEC * predicted_s / elapsed if elapsed > 0 else 0.0
+    logger.info(f"⏱️  Fin previsto: {predicted_end:%H:%M:%S} | real: {datetime.now():%H:%M:%S} "
+                f"({elapsed - predicted_s:+,.0f} s) | ritmo medido: {measured:.2f} MB/s por worker (PGN_MB_PER_SEC)")
+    for count, player, time_control, num_games, size_mb in file_results:
+        total_positions += count
+        results.append({
+            'player': player,
+            'time_control': time_control,
+            'games': num_games,
+            'positions': count,
+            'size_mb': size_mb
+        })
+
+    num_shards = shard_processed_files()
+
+    # === MÉTRICAS POR ETAPA ===
+    summary = summarize(load_run(METRICS_FILE, run_id), elapsed, pool_size, main_pid=os.getpid())
+    save_summary(summary)
+    logger.info("-" * 80)
+    logger.info(f"⏲️  MÉTRICAS POR ETAPA (detalle en {METRICS_FILE})")
+    logger.info("-" * 80)
+    for line in format_summary(summary):
+        logger.info(line)
 
     # === RESUMEN FINAL ===
     logger.info("-" * 80)
@@ -350,6 +936,7 @@ def process_all_games():
     logger.info(f"📁 Archivos procesados:            {len(results)}")
     logger.info(f"✅ Archivos .npz generados:        {len([r for r in results if r['positions'] > 0])}")
     logger.info(f"⚠️  Archivos sin datos:             {len([r for r in results if r['positions'] == 0])}")
+    logger.info(f"📦 Shards nuevos:                  {num_shards}")
     logger.info("🎉 ¡Procesamiento completado con éxito!")
     logger.info("=" * 80)
 
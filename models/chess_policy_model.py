@@ -4,7 +4,36 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 
-def create_policy_model(input_shape=(8, 8, 29)):
+from src.conversor.board_representation import resolve_feature_set
+from src.conversor.plane_packing import quantization_params
+
+
+@keras.utils.register_keras_serializable(package="lilichess")
+class DequantizePlanes(layers.Layer):
+    """
+    Convierte planos uint8 cuantizados (ver plane_packing.quantize_planes) a
+    valores reales dentro del modelo, para que el host y el bus a la GPU
+    muevan 1 byte por valor en vez de 4.
+    """
+
+    def __init__(self, planes, **kwargs):
+        super().__init__(**kwargs)
+        self.planes = [int(p) for p in planes]
+        scale, offset = quantization_params(self.planes)
+        self._scale = scale
+        self._offset = offset
+
+    def call(self, inputs):
+        x = tf.cast(inputs, self.compute_dtype)
+        return (x - tf.cast(self._offset, self.compute_dtype)) / tf.cast(self._scale, self.compute_dtype)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"planes": self.planes})
+        return config
+
+
+def create_policy_model(input_shape=(8, 8, 29), feature_set=None, input_dtype="float32"):
     """
     Modelo de política para ajedrez, optimizado para entrenamiento en GPU con 4 GB de VRAM.
     
@@ -16,15 +45,22 @@ def create_policy_model(input_shape=(8, 8, 29)):
     
     Args:
         input_shape (tuple): Forma de entrada (8, 8, 29) → tablero + planos de características.
+        feature_set (str | list): Conjunto de planos del codificador ("full-29", "core-22", ...).
+            Si se indica, la forma de entrada sale de él e ignora input_shape.
+        input_dtype (str): Tipo de los planos de entrada: "float32", "float16" o "uint8"
+            (cuantizados; el modelo los convierte a real en su primera capa).
         num_actions (int): Número de tipos de movimientos (73 es estándar en Leela Chess Zero).
     
     Returns:
         keras.Model: Modelo listo para entrenar con .fit().
     """
-    inputs = layers.Input(shape=input_shape)
+    planes = resolve_feature_set(feature_set) if feature_set is not None else tuple(range(input_shape[-1]))
+    input_shape = tuple(input_shape[:-1]) + (len(planes),)
+    inputs = layers.Input(shape=input_shape, dtype=input_dtype)
+    x = DequantizePlanes(planes, name='dequantize')(inputs) if input_dtype == "uint8" else inputs
 
     # === Stem: convolución inicial ===
-    x = layers.Conv2D(64, (3, 3), padding='same', name='stem_conv')(inputs)
+    x = layers.Conv2D(64, (3, 3), padding='same', name='stem_conv')(x)
     x = layers.BatchNormalization(name='stem_bn')(x)
     x = layers.LeakyReLU(alpha=0.01, name='stem_activation')(x)
 
@@ -69,10 +105,10 @@ def create_policy_model(input_shape=(8, 8, 29)):
     # Compilación
     model.compile(
         optimizer=keras.optimizers.Adam(learning_rate=3e-4),
-        loss='categorical_crossentropy',  # Usa one-hot encoding (mejor para softmax)
+        loss='sparse_categorical_crossentropy',  # Etiquetas como índices de clase (sin one-hot)
         metrics=[
-            'accuracy',
-            keras.metrics.TopKCategoricalAccuracy(k=5, name='top_5_accuracy')
+            'sparse_categorical_accuracy',
+            keras.metrics.SparseTopKCategoricalAccuracy(k=5, name='top_5_accuracy')
         ]
     )
     return model
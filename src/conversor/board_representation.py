@@ -2,58 +2,597 @@
 import chess
 import numpy as np
 
-def fen_to_8x8x29(fen: str, last_moves: list = None):
+from src.conversor.plane_packing import quantize_planes
+from src.move_encoding import mirror_move
+
+# Versión del codificador: cambiarla si cambia el significado de algún plano
+ENCODER_VERSION = "8x8x29-v1"
+
+# Orden de los planos de piezas: blancas 0-5, negras 6-11
+PIECE_TYPES = (chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING)
+
+# Casillas fuera de la fila inicial de las piezas menores (plano 26)
+_WHITE_DEVELOPED = ~(chess.BB_RANK_1 | chess.BB_RANK_2) & chess.BB_ALL
+_BLACK_DEVELOPED = ~(chess.BB_RANK_7 | chess.BB_RANK_8) & chess.BB_ALL
+
+# Planos que salen de un bitboard: 0-11 piezas y 26 piezas desarrolladas
+_BITBOARD_PLANES = list(range(12)) + [26]
+
+# === Registro de planos ===
+PLANE_NAMES = (
+    "white_pawn", "white_knight", "white_bishop", "white_rook", "white_queen", "white_king",  # 0-5
+    "black_pawn", "black_knight", "black_bishop", "black_rook", "black_queen", "black_king",  # 6-11
+    "turn",                                                      # 12
+    "castle_white_king", "castle_white_queen",                   # 13-14
+    "castle_black_king", "castle_black_queen",                   # 15-16
+    "en_passant", "check", "fifty_moves",                        # 17-19
+    "last_move_1", "last_move_2",                                # 20-21
+    "white_king_center", "black_king_center",                    # 22-23
+    "center_control", "pawn_structure", "developed",             # 24-26
+    "attack_map", "mobility",                                    # 27-28
+)
+
+# Grupos de planos que se calculan juntos (una sola pasada por grupo)
+PLANE_GROUPS = {
+    "pieces": _BITBOARD_PLANES,
+    "turn": [12],
+    "castling": [13, 14, 15, 16],
+    "en_passant": [17],
+    "check_clock": [18, 19],
+    "last_moves": [20, 21],
+    "kings": [22, 23],
+    "pawn_structure": [25],
+    "attacks": [24, 27],
+    "mobility": [28],
+}
+ALL_GROUPS = frozenset(PLANE_GROUPS)
+# Grupos que dependen de todo el tablero y cambian con cualquier movimiento
+_GLOBAL_GROUPS = frozenset({"attacks", "mobility"})
+
+# Conjuntos de planos con nombre
+FEATURE_SETS = {
+    "full-29": tuple(range(29)),
+    # Solo planos de estado, sin características derivadas
+    "core-22": tuple(range(22)),
+    # Todo menos los planos caros (control del centro, peones, ataques, movilidad)
+    "cheap-25": tuple(p for p in range(29) if p not in (24, 25, 27, 28)),
+}
+DEFAULT_FEATURE_SET = "full-29"
+
+
+def resolve_feature_set(feature_set=DEFAULT_FEATURE_SET) -> tuple:
+    """
+    Traduce un conjunto de planos a la tupla de índices en el array 8x8x29.
+
+    Args:
+        feature_set: nombre de FEATURE_SETS ("full-29", "core-22", ...) o una
+            lista de índices y/o nombres de PLANE_NAMES, en el orden deseado.
+    """
+    if isinstance(feature_set, str):
+        if feature_set not in FEATURE_SETS:
+            raise ValueError(f"Conjunto de planos desconocido: {feature_set!r}. Opciones: {sorted(FEATURE_SETS)}")
+        return FEATURE_SETS[feature_set]
+
+    planes = []
+    for plane in feature_set:
+        if isinstance(plane, str):
+            if plane not in PLANE_NAMES:
+                raise ValueError(f"Plano desconocido: {plane!r}")
+            plane = PLANE_NAMES.index(plane)
+        plane = int(plane)
+        if not 0 <= plane < len(PLANE_NAMES):
+            raise ValueError(f"Índice de plano fuera de rango: {plane}")
+        if plane in planes:
+            raise ValueError(f"Plano repetido: {plane}")
+        planes.append(plane)
+    if not planes:
+        raise ValueError("El conjunto de planos está vacío")
+    return tuple(planes)
+
+
+def num_planes(feature_set=DEFAULT_FEATURE_SET) -> int:
+    """Número de canales de entrada que produce un conjunto de planos."""
+    return len(resolve_feature_set(feature_set))
+
+
+def groups_for_planes(planes) -> frozenset:
+    """Grupos que hay que calcular para obtener los planos pedidos."""
+    wanted = set(planes)
+    return frozenset(name for name, group in PLANE_GROUPS.items() if wanted & set(group))
+
+
+def bitboards_to_planes(bitboards) -> np.ndarray:
+    """
+    Convierte una secuencia de N bitboards en un array (8, 8, N) de 0/1.
+    La fila 0 corresponde al rango 8 y la columna 0 a la columna 'a',
+    igual que en el resto de planos.
+    """
+    bbs = np.asarray(bitboards, dtype='<u8')
+    bits = np.unpackbits(bbs.view(np.uint8).reshape(-1, 8), axis=-1, bitorder='little')
+    # (N, rango, columna) → invertir rangos para que la fila 0 sea el rango 8
+    return bits.reshape(-1, 8, 8)[:, ::-1, :].transpose(1, 2, 0)
+
+
+def canonical_board(board: chess.Board, last_moves: list = None):
+    """
+    Posición vista desde el lado que mueve. Si mueven las negras se devuelve
+    board.mirror() (filas invertidas y colores intercambiados) y los últimos
+    movimientos reflejados, así que siempre "juegan las blancas".
+
+    Las jugadas de la política se pasan al mismo sistema con
+    move_encoding.canonical_uci y se deshacen con flat_index_to_uci(i, mirror=True).
+    """
+    if board.turn == chess.WHITE:
+        return board, last_moves
+    return board.mirror(), _mirror_history(last_moves)
+
+
+def fen_to_8x8x29(fen: str, last_moves: list = None, canonical: bool = False):
     """
     Convierte un FEN a un array 8x8x29.
     Cada plano representa una característica del tablero.
+    Con canonical=True la posición se codifica desde el lado que mueve
+    (ver canonical_board).
     """
-    if last_moves is None:
-        last_moves = []
-    
     board = chess.Board(fen)
+    if canonical:
+        board, last_moves = canonical_board(board, last_moves)
     planes = np.zeros((8, 8, 29), dtype=np.float32)
-    piece_to_index = {'P': 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4, 'K': 5}
-    
-    # 0-11: Piezas (blancas 0-5, negras 6-11)
-    for i in range(8):
-        for j in range(8):
-            sq = chess.square(j, 7 - i)
-            piece = board.piece_at(sq)
-            if piece:
-                idx = piece_to_index[piece.symbol().upper()]
-                if piece.color == chess.WHITE:
-                    planes[i, j, idx] = 1
-                else:
-                    planes[i, j, idx + 6] = 1
-    
+    _encode_board(board, last_moves, board.ep_square, planes)
+    return planes
+
+
+def board_to_8x8x29(board: chess.Board, last_moves: list = None, out: np.ndarray = None,
+                    canonical: bool = False):
+    """
+    Igual que fen_to_8x8x29(board.fen(), last_moves) pero sin pasar por FEN:
+    los planos de piezas, turno, enroque y al paso salen de los bitboards
+    del tablero vivo.
+
+    board.fen() solo escribe la casilla al paso si la captura es legal,
+    así que aquí se aplica el mismo filtro para que la salida sea idéntica.
+
+    Si se pasa `out` (un array (8, 8, 29), p. ej. out=arena[i]) se escribe
+    ahí y no se reserva memoria nueva.
+    """
+    if canonical:
+        board, last_moves = canonical_board(board, last_moves)
+    if out is None:
+        out = np.zeros((8, 8, 29), dtype=np.float32)
+    else:
+        out.fill(0)
+    _encode_board(board, last_moves, _legal_ep_square(board), out)
+    return out
+
+
+def encode_boards(boards, last_moves=None, out: np.ndarray = None, canonical: bool = False):
+    """
+    Codifica N tableros en un único array (N, 8, 8, 29).
+
+    Args:
+        boards: secuencia de chess.Board.
+        last_moves: secuencia paralela con los últimos movimientos UCI de
+            cada tablero (o None si no hay historial).
+        out: buffer opcional de forma (M, 8, 8, 29) con M >= N, o una
+            porción de uno más grande. Se escriben las N primeras filas.
+        canonical: codificar cada posición desde el lado que mueve.
+
+    Returns:
+        np.ndarray: la vista out[:N] con las posiciones codificadas.
+    """
+    n = len(boards)
+    if last_moves is not None and len(last_moves) != n:
+        raise ValueError(f"last_moves tiene {len(last_moves)} elementos, se esperaban {n}")
+    if out is None:
+        out = np.zeros((n, 8, 8, 29), dtype=np.float32)
+    else:
+        if out.ndim != 4 or out.shape[1:] != (8, 8, 29) or out.shape[0] < n:
+            raise ValueError(f"out debe tener forma (>= {n}, 8, 8, 29), tiene {out.shape}")
+        out[:n] = 0
+
+    for i, board in enumerate(boards):
+        history = last_moves[i] if last_moves is not None else None
+        if canonical:
+            board, history = canonical_board(board, history)
+        _encode_board(board, history, _legal_ep_square(board), out[i])
+    return out[:n]
+
+
+class BoardEncoder:
+    """
+    Codificador configurable por conjunto de planos.
+
+    Solo calcula los grupos de planos que necesita el conjunto elegido, así
+    que con "core-22" o "cheap-25" nunca se recorren ataques ni movilidad.
+    La salida tiene forma (8, 8, num_planes) con los planos en el orden del
+    conjunto.
+
+    Con `cache` (un PositionCache) las posiciones repetidas se copian de la
+    caché en lugar de recalcularse.
+
+    Con canonical=True cada posición se codifica desde el lado que mueve
+    (ver canonical_board); una posición y su reflejo comparten entrada en
+    la caché.
+
+    Uso:
+        encoder = BoardEncoder("cheap-25")
+        planes = encoder.encode(board, last_moves)
+    """
+
+    def __init__(self, feature_set=DEFAULT_FEATURE_SET, cache=None, canonical: bool = False):
+        self.planes = resolve_feature_set(feature_set)
+        self.num_planes = len(self.planes)
+        self.groups = groups_for_planes(self.planes)
+        self.cache = cache
+        self.canonical = canonical
+        self._full = self.planes == FEATURE_SETS["full-29"]
+        self._scratch = np.zeros((8, 8, 29), dtype=np.float32)
+
+    @property
+    def input_shape(self) -> tuple:
+        return (8, 8, self.num_planes)
+
+    def encode(self, board: chess.Board, last_moves: list = None, out: np.ndarray = None) -> np.ndarray:
+        """
+        Codifica un tablero vivo (mismos valores que board_to_8x8x29).
+        `out` puede ser float32, float16 o uint8 (planos cuantizados, ver
+        plane_packing.quantize_planes).
+        """
+        if self.canonical:
+            board, last_moves = canonical_board(board, last_moves)
+        if out is None:
+            out = np.empty(self.input_shape, dtype=np.float32)
+        full_out = self._full and out.dtype == np.float32
+
+        key = self.cache.key(board, last_moves, self.groups) if self.cache is not None else None
+        planes = self.cache.get(key) if key is not None else None
+        if planes is None:
+            planes = out if full_out else self._scratch
+            planes.fill(0)
+            _encode_board(board, last_moves, _legal_ep_square(board), planes, self.groups)
+            if key is not None:
+                self.cache.put(key, planes)
+
+        if planes is not out:
+            _store_planes(planes, self.planes, self._full, out)
+        return out
+
+    def encode_boards(self, boards, last_moves=None, out: np.ndarray = None) -> np.ndarray:
+        """Versión por lotes: escribe N tableros en out (N, 8, 8, num_planes)."""
+        n = len(boards)
+        if last_moves is not None and len(last_moves) != n:
+            raise ValueError(f"last_moves tiene {len(last_moves)} elementos, se esperaban {n}")
+        if out is None:
+            out = np.empty((n,) + self.input_shape, dtype=np.float32)
+        elif out.ndim != 4 or out.shape[1:] != self.input_shape or out.shape[0] < n:
+            raise ValueError(f"out debe tener forma (>= {n}, 8, 8, {self.num_planes}), tiene {out.shape}")
+        for i, board in enumerate(boards):
+            self.encode(board, last_moves[i] if last_moves is not None else None, out=out[i])
+        return out[:n]
+
+
+class PlaneArena:
+    """
+    Buffer (capacidad, 8, 8, num_planes) reutilizable para acumular
+    posiciones codificadas sin crear un array por posición.
+    Crece por duplicación cuando se queda corto; reset() lo vacía y puede
+    dejarlo ya con la capacidad prevista, para no crecer por el camino.
+    """
+
+    def __init__(self, capacity: int = 4096, dtype=np.float32, num_planes: int = 29):
+        self.buffer = np.empty((max(1, capacity), 8, 8, num_planes), dtype=dtype)
+        self._shape, self._dtype = self.buffer.shape[1:], self.buffer.dtype
+        self.size = 0
+
+    def reserve(self, n: int) -> np.ndarray:
+        """Devuelve una vista escribible con espacio para n posiciones más."""
+        needed = self.size + n
+        if needed > len(self.buffer):
+            capacity = len(self.buffer)
+            while capacity < needed:
+                capacity *= 2
+            grown = np.empty((capacity,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            grown[:self.size] = self.buffer[:self.size]
+            self.buffer = grown
+        return self.buffer[self.size:needed]
+
+    def commit(self, n: int):
+        """Marca como usadas n posiciones escritas en la última reserva."""
+        self.size += n
+
+    def view(self) -> np.ndarray:
+        """Posiciones escritas hasta ahora (sin copia)."""
+        return self.buffer[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+    def reset(self, capacity: int = 0):
+        """Vacía el arena y, si `capacity` no cabe, lo cambia por uno de ese tamaño (sin copiar nada)."""
+        self.size = 0
+        if capacity > len(self.buffer):
+            self.buffer = None  # libera el anterior antes de reservar el nuevo
+            self.buffer = np.empty((capacity,) + self._shape, dtype=self._dtype)
+
+
+class GameEncoder:
+    """
+    Codificador incremental de una partida.
+
+    Mantiene los planos de la posición actual y, en cada push(), solo
+    corrige lo que el movimiento puede cambiar: las casillas tocadas en los
+    planos de piezas, los planos 20-21 de últimos movimientos, turno, jaque,
+    reloj, enroque y al paso. La estructura de peones (25) y la distancia de
+    los reyes (22-23) se recalculan solo si cambian los peones o los reyes;
+    ataques (24, 27) y movilidad (28) dependen de todo el tablero y se
+    recalculan en cada posición, al pedirla con encode(). Con `cache` (un
+    PositionCache) una posición ya vista se copia de la caché en su lugar.
+
+    Produce exactamente lo mismo que board_to_8x8x29(board, historial[-2:]),
+    o BoardEncoder(feature_set).encode(...) si se elige un conjunto de planos;
+    en ese caso los grupos que no se piden no se calculan nunca.
+
+    Con canonical=True se lleva en paralelo un segundo codificador sobre el
+    tablero reflejado, y las posiciones con negras al turno salen de él
+    (igual que board_to_8x8x29(..., canonical=True)).
+
+    Con copy_board=False se usa el propio `board` en lugar de una copia:
+    quien lo mueve (p. ej. el parser de PGN) avisa con update(move).
+
+    Uso:
+        encoder = GameEncoder(game.board())
+        X = encoder.encode_moves(game.mainline_moves())
+    """
+
+    def __init__(self, board: chess.Board = None, feature_set=DEFAULT_FEATURE_SET, cache=None,
+                 canonical: bool = False, copy_board: bool = True):
+        if board is None:
+            board = chess.Board()
+        self.board = board.copy() if copy_board else board
+        self.canonical = canonical
+        self._mirrored = GameEncoder(self.board.mirror(), feature_set, cache) if canonical else None
+        self.history = []
+        self.feature_planes = resolve_feature_set(feature_set)
+        self.num_planes = len(self.feature_planes)
+        self.groups = groups_for_planes(self.feature_planes)
+        self.cache = cache
+        self._full = self.feature_planes == FEATURE_SETS["full-29"]
+        self.planes = np.zeros((8, 8, 29), dtype=np.float32)
+        self._bitboards = _piece_bitboards(self.board)
+        self._ep_square = _legal_ep_square(self.board)
+        self._castling = self.board.clean_castling_rights()
+        self._pawns = self._pawn_key()
+        self._kings = self.board.kings
+        _encode_board(self.board, self.history, self._ep_square, self.planes, self.groups - _GLOBAL_GROUPS)
+        self._stale = True
+
+    @property
+    def encoded_board(self) -> chess.Board:
+        """Tablero que se codifica: el reflejado si canonical y mueven las negras."""
+        if self._mirrored is not None and self.board.turn == chess.BLACK:
+            return self._mirrored.board
+        return self.board
+
+    def encode(self, out: np.ndarray = None) -> np.ndarray:
+        """
+        Planos (8, 8, num_planes) de la posición actual (copia, o escritos en
+        `out`, que puede ser float32, float16 o uint8 cuantizado).
+        """
+        if self._mirrored is not None and self.board.turn == chess.BLACK:
+            return self._mirrored.encode(out)
+        if self._stale:
+            self._refresh_global_planes()
+        if out is None:
+            out = np.empty((8, 8, self.num_planes), dtype=np.float32)
+        _store_planes(self.planes, self.feature_planes, self._full, out)
+        return out
+
+    def push(self, move: chess.Move):
+        """Juega `move` y actualiza los planos."""
+        self.board.push(move)
+        self.update(move)
+
+    def update(self, move: chess.Move):
+        """Actualiza los planos tras `move`, que ya se ha jugado en self.board."""
+        board = self.board
+        self.history.append(move)
+        if self._mirrored is not None:
+            self._mirrored.push(mirror_move(move))
+        planes = self.planes
+
+        groups = self.groups
+
+        # 0-11 y 26: solo las casillas cuyo bit ha cambiado
+        if "pieces" in groups:
+            bitboards = _piece_bitboards(board)
+            for plane, old, new in zip(_BITBOARD_PLANES, self._bitboards, bitboards):
+                changed = old ^ new
+                for sq in chess.scan_forward(changed):
+                    planes[7 - chess.square_rank(sq), chess.square_file(sq), plane] = 1 if new & chess.BB_SQUARES[sq] else 0
+            self._bitboards = bitboards
+
+        if "turn" in groups:
+            _fill_turn_plane(board, planes)
+
+        if "castling" in groups:
+            castling = board.clean_castling_rights()
+            if castling != self._castling:
+                _fill_castling_planes(board, planes)
+                self._castling = castling
+
+        if "en_passant" in groups:
+            ep_square = _legal_ep_square(board)
+            if ep_square != self._ep_square:
+                planes[:, :, 17] = 0
+                _fill_ep_plane(ep_square, planes)
+                self._ep_square = ep_square
+
+        if "check_clock" in groups:
+            _fill_check_and_clock_planes(board, planes)
+
+        if "last_moves" in groups:
+            planes[:, :, 20:22] = 0
+            _fill_last_moves_planes(self.history[-2:], planes)
+
+        if "kings" in groups and board.kings != self._kings:
+            _fill_king_planes(board, planes)
+            self._kings = board.kings
+
+        if "pawn_structure" in groups:
+            pawns = self._pawn_key()
+            if pawns != self._pawns:
+                _fill_pawn_structure_plane(board, planes)
+                self._pawns = pawns
+
+        self._stale = True
+
+    def _refresh_global_planes(self):
+        """Ataques y movilidad de la posición actual, de la caché si está."""
+        self._stale = False
+        key = self.cache.key(self.board, self.history, self.groups) if self.cache is not None else None
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            self.planes[...] = cached
+            return
+        if "attacks" in self.groups:
+            _fill_attack_planes(self.board, self.planes)
+        if "mobility" in self.groups:
+            _fill_mobility_plane(self.board, self.planes)
+        if key is not None:
+            self.cache.put(key, self.planes)
+
+    def encode_moves(self, moves, out: np.ndarray = None) -> np.ndarray:
+        """
+        Codifica la posición actual y las que siguen a cada movimiento de
+        `moves` excepto la última (la posición antes de cada movimiento,
+        que es lo que se usa como entrada de la política).
+
+        Devuelve un array (N, 8, 8, num_planes); si se pasa `out` (float32,
+        float16 o uint8) se escribe en él.
+        """
+        moves = list(moves)
+        if out is None:
+            out = np.empty((len(moves), 8, 8, self.num_planes), dtype=np.float32)
+        elif out.shape[0] < len(moves):
+            raise ValueError(f"out tiene {out.shape[0]} filas, se necesitan {len(moves)}")
+        for i, move in enumerate(moves):
+            self.encode(out=out[i])
+            self.push(move)
+        return out[:len(moves)]
+
+    def _pawn_key(self):
+        board = self.board
+        return board.pawns & board.occupied_co[chess.WHITE], board.pawns & board.occupied_co[chess.BLACK]
+
+
+def _store_planes(planes, feature_planes, full, out):
+    """Copia los planos elegidos de `planes` (8, 8, 29) a `out`, según su tipo."""
+    selected = planes if full else planes[..., feature_planes]
+    if out.dtype == np.uint8:
+        quantize_planes(selected, feature_planes, out=out)
+    else:
+        out[...] = selected
+
+
+def _mirror_history(last_moves):
+    """Refleja los últimos movimientos (UCI o chess.Move); los inválidos se dejan tal cual."""
+    if not last_moves:
+        return last_moves
+    mirrored = []
+    for move in last_moves:
+        try:
+            mirrored.append(mirror_move(chess.Move.from_uci(move) if isinstance(move, str) else move))
+        except ValueError:
+            mirrored.append(move)
+    return mirrored
+
+
+def _legal_ep_square(board: chess.Board):
+    return board.ep_square if board.has_legal_en_passant() else None
+
+
+def _encode_board(board: chess.Board, last_moves, ep_square, planes, groups=ALL_GROUPS):
+    """
+    Rellena en `planes` (8, 8, 29), que debe llegar a cero, los grupos de
+    planos indicados. Los demás se quedan a cero sin calcularse.
+    """
+    if "pieces" in groups:
+        _fill_piece_planes(_piece_bitboards(board), planes)
+    if "turn" in groups:
+        _fill_turn_plane(board, planes)
+    if "castling" in groups:
+        _fill_castling_planes(board, planes)
+    if "en_passant" in groups:
+        _fill_ep_plane(ep_square, planes)
+    if "check_clock" in groups:
+        _fill_check_and_clock_planes(board, planes)
+    if "last_moves" in groups:
+        _fill_last_moves_planes(last_moves, planes)
+    if "kings" in groups:
+        _fill_king_planes(board, planes)
+    if "pawn_structure" in groups:
+        _fill_pawn_structure_plane(board, planes)
+    if "attacks" in groups:
+        _fill_attack_planes(board, planes)
+    if "mobility" in groups:
+        _fill_mobility_plane(board, planes)
+
+
+# === Planos por grupos ===
+# Cada función escribe solo sus planos; así el codificador incremental
+# (GameEncoder) puede recalcular únicamente los que cambian con un movimiento.
+
+def _piece_bitboards(board: chess.Board) -> list:
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    minors = board.knights | board.bishops
+    bitboards = [board.pieces_mask(pt, chess.WHITE) for pt in PIECE_TYPES]
+    bitboards += [board.pieces_mask(pt, chess.BLACK) for pt in PIECE_TYPES]
+    bitboards.append((minors & white & _WHITE_DEVELOPED) | (minors & black & _BLACK_DEVELOPED))
+    return bitboards
+
+
+def _fill_piece_planes(bitboards, planes):
+    # 0-11: Piezas (blancas 0-5, negras 6-11) y 26: piezas menores desarrolladas
+    planes[:, :, _BITBOARD_PLANES] = bitboards_to_planes(bitboards)
+
+
+def _fill_turn_plane(board, planes):
     # 12: Turno (1 si es blanco)
-    if board.turn == chess.WHITE:
-        planes[:, :, 12] = 1
-    
+    planes[:, :, 12] = 1 if board.turn == chess.WHITE else 0
+
+
+def _fill_castling_planes(board, planes):
     # 13-16: Enroque
-    if board.has_kingside_castling_rights(chess.WHITE): planes[:, :, 13] = 1
-    if board.has_queenside_castling_rights(chess.WHITE): planes[:, :, 14] = 1
-    if board.has_kingside_castling_rights(chess.BLACK): planes[:, :, 15] = 1
-    if board.has_queenside_castling_rights(chess.BLACK): planes[:, :, 16] = 1
-    
+    planes[:, :, 13] = 1 if board.has_kingside_castling_rights(chess.WHITE) else 0
+    planes[:, :, 14] = 1 if board.has_queenside_castling_rights(chess.WHITE) else 0
+    planes[:, :, 15] = 1 if board.has_kingside_castling_rights(chess.BLACK) else 0
+    planes[:, :, 16] = 1 if board.has_queenside_castling_rights(chess.BLACK) else 0
+
+
+def _fill_ep_plane(ep_square, planes):
     # 17: Al paso
-    if board.ep_square:
-        file = chess.square_file(board.ep_square)
-        rank = 7 - chess.square_rank(board.ep_square)
+    if ep_square:
+        file = chess.square_file(ep_square)
+        rank = 7 - chess.square_rank(ep_square)
         planes[rank, file, 17] = 1
-    
+
+
+def _fill_check_and_clock_planes(board, planes):
     # 18: Jaque
-    if board.is_check():
-        planes[:, :, 18] = 1
-    
+    planes[:, :, 18] = 1 if board.is_check() else 0
+
     # 19: 50 movimientos sin progreso
     planes[:, :, 19] = 1 if board.halfmove_clock >= 50 else 0
-    
+
+
+def _fill_last_moves_planes(last_moves, planes):
     # 20-21: Últimos 2 movimientos
+    if not last_moves:
+        return
     recent_moves = last_moves[-2:]
     for k, move_uci in enumerate(recent_moves):
         try:
-            move = chess.Move.from_uci(move_uci)
+            move = chess.Move.from_uci(move_uci) if isinstance(move_uci, str) else move_uci
             fr = move.from_square
             to = move.to_square
             i_fr, j_fr = 7 - chess.square_rank(fr), chess.square_file(fr)
@@ -62,70 +601,178 @@ def fen_to_8x8x29(fen: str, last_moves: list = None):
             planes[i_to, j_to, 20 + k] = 1
         except:
             pass
-    
+
+
+def _king_distance(king_sq) -> float:
+    return ((chess.square_file(king_sq) - 3.5)**2 + (7 - chess.square_rank(king_sq) - 3.5)**2)**0.5 / 6
+
+
+def _fill_king_planes(board, planes):
     # 22: Distancia del rey blanco al centro
-    w_king = board.king(chess.WHITE)
-    if w_king:
-        dist = ((chess.square_file(w_king) - 3.5)**2 + (7 - chess.square_rank(w_king) - 3.5)**2)**0.5
-        planes[:, :, 22] = dist / 6
-    
     # 23: Distancia del rey negro al centro
+    # (un rey en a1 es la casilla 0 y deja el plano a cero, como siempre)
+    w_king = board.king(chess.WHITE)
+    planes[:, :, 22] = _king_distance(w_king) if w_king else 0
     b_king = board.king(chess.BLACK)
-    if b_king:
-        dist = ((chess.square_file(b_king) - 3.5)**2 + (7 - chess.square_rank(b_king) - 3.5)**2)**0.5
-        planes[:, :, 23] = dist / 6
-    
-    # 24: Control del centro (d4, d5, e4, e5)
-    center = [chess.D4, chess.D5, chess.E4, chess.E5]
-    for sq in center:
-        i, j = 7 - chess.square_rank(sq), chess.square_file(sq)
-        attackers = len(board.attackers(chess.WHITE, sq)) - len(board.attackers(chess.BLACK, sq))
-        planes[i, j, 24] = np.tanh(attackers / 3)
-    
-    # 25: Estructura de peones (dobles, pasados)
-    for sq in board.pieces(chess.PAWN, chess.WHITE):
+    planes[:, :, 23] = _king_distance(b_king) if b_king else 0
+
+
+_CENTER = [chess.D4, chess.D5, chess.E4, chess.E5]
+
+
+def _fill_pawn_structure_plane(board, planes):
+    # 25: Estructura de peones de las blancas (doblados 0.5, pasados 1.0)
+    planes[:, :, 25] = 0
+    white_pawns = board.pawns & board.occupied_co[chess.WHITE]
+    black_pawns = board.pawns & board.occupied_co[chess.BLACK]
+    for sq in chess.scan_forward(white_pawns):
         file = chess.square_file(sq)
         rank = chess.square_rank(sq)
-        # Peón doblado
-        if any(chess.square_file(p) == file and chess.square_rank(p) < rank for p in board.pieces(chess.PAWN, chess.WHITE)):
-            planes[7 - rank, file, 25] = 0.5
-        # Peón pasado
-        is_passed = True
-        for f in [file-1, file, file+1]:
-            if 0 <= f <= 7:
-                for r in range(rank+1, 8):
-                    if board.piece_at(chess.square(f, r)) and board.piece_at(chess.square(f, r)).piece_type == chess.PAWN and board.piece_at(chess.square(f, r)).color == chess.BLACK:
-                        is_passed = False
-        if is_passed:
+        below = (1 << (8 * rank)) - 1
+        above = chess.BB_ALL & ~((1 << (8 * (rank + 1))) - 1)
+        adjacent = chess.BB_FILES[file]
+        if file > 0:
+            adjacent |= chess.BB_FILES[file - 1]
+        if file < 7:
+            adjacent |= chess.BB_FILES[file + 1]
+        # Peón pasado: ningún peón negro delante en su columna o las vecinas
+        if not black_pawns & adjacent & above:
             planes[7 - rank, file, 25] = 1.0
-    
-    # 26: Piezas desarrolladas (N y B fuera de la fila inicial)
-    for sq in board.pieces(chess.KNIGHT, chess.WHITE):
-        if chess.square_rank(sq) > 1:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.BISHOP, chess.WHITE):
-        if chess.square_rank(sq) > 1:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.KNIGHT, chess.BLACK):
-        if chess.square_rank(sq) < 6:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    for sq in board.pieces(chess.BISHOP, chess.BLACK):
-        if chess.square_rank(sq) < 6:
-            planes[7 - chess.square_rank(sq), chess.square_file(sq), 26] = 1
-    
-    # 27: Mapa de ataques
-    for i in range(8):
-        for j in range(8):
-            sq = chess.square(j, 7 - i)
-            diff = len(board.attackers(chess.WHITE, sq)) - len(board.attackers(chess.BLACK, sq))
-            planes[i, j, 27] = np.tanh(diff / 5)
-    
+        # Peón doblado: otro peón blanco detrás en la misma columna
+        elif white_pawns & chess.BB_FILES[file] & below:
+            planes[7 - rank, file, 25] = 0.5
+
+
+# Desplazamientos de las capturas de peón por color: (desplazamiento, columna que no puede
+# ser destino para no "dar la vuelta" al tablero)
+_PAWN_CAPTURE_SHIFTS = {
+    chess.WHITE: ((7, chess.BB_FILE_H), (9, chess.BB_FILE_A)),
+    chess.BLACK: ((-9, chess.BB_FILE_H), (-7, chess.BB_FILE_A)),
+}
+
+
+def _shift(bb: int, offset: int) -> int:
+    return (bb << offset) & chess.BB_ALL if offset > 0 else bb >> -offset
+
+
+def _square_counts(bitboards, weights) -> np.ndarray:
+    """
+    Suma ponderada de bitboards casilla a casilla (popcount vectorizado).
+    Devuelve un array (8, 8) con la fila 0 = rango 8.
+    """
+    if not bitboards:
+        return np.zeros((8, 8))
+    bbs = np.asarray(bitboards, dtype='<u8')
+    bits = np.unpackbits(bbs.view(np.uint8).reshape(-1, 8), axis=-1, bitorder='little')
+    counts = np.asarray(weights, dtype=np.float64) @ bits
+    return counts.reshape(8, 8)[::-1]
+
+
+def _attack_bitboards(board: chess.Board, color: chess.Color) -> list:
+    """
+    Bitboards de ataque de las piezas de `color`: uno por pieza, salvo los
+    peones, que van en dos bitboards (captura a cada lado) para todos a la vez.
+    Cada casilla aparece una vez por atacante, como en board.attackers().
+    """
+    pieces = board.occupied_co[color]
+    pawns = board.pawns & pieces
+    bitboards = [_shift(pawns, offset) & ~edge for offset, edge in _PAWN_CAPTURE_SHIFTS[color]]
+    for sq in chess.scan_forward(pieces & ~board.pawns):
+        bitboards.append(board.attacks_mask(sq))
+    return bitboards
+
+
+def _fill_attack_planes(board, planes):
+    # 27: Mapa de ataques (atacantes blancos - negros por casilla)
+    white = _attack_bitboards(board, chess.WHITE)
+    black = _attack_bitboards(board, chess.BLACK)
+    diff = _square_counts(white + black, [1] * len(white) + [-1] * len(black))
+    planes[:, :, 27] = np.tanh(diff / 5)
+
+    # 24: Control del centro (d4, d5, e4, e5), con la misma diferencia
+    planes[:, :, 24] = 0
+    for sq in _CENTER:
+        i, j = 7 - chess.square_rank(sq), chess.square_file(sq)
+        planes[i, j, 24] = np.tanh(diff[i, j] / 3)
+
+
+# Casillas en línea recta o diagonal desde cada casilla (tablero vacío)
+_QUEEN_LINES = [
+    chess.BB_RANK_ATTACKS[sq][0] | chess.BB_FILE_ATTACKS[sq][0] | chess.BB_DIAG_ATTACKS[sq][0]
+    for sq in chess.SQUARES
+]
+
+
+def _pawn_move_targets(board: chess.Board, pawns: int, color: chess.Color, mask: int = chess.BB_ALL):
+    """
+    Destinos (bitboard, peso) de los avances y capturas de `pawns`, limitados
+    a `mask`. Las coronaciones cuentan 4 veces (una por pieza), igual que en
+    board.legal_moves. La captura al paso se cuenta aparte.
+    """
+    empty = ~board.occupied & chess.BB_ALL
+    enemies = board.occupied_co[not color]
+    forward, start_rank, last_rank = (8, chess.BB_RANK_3, chess.BB_RANK_8) if color == chess.WHITE else (-8, chess.BB_RANK_6, chess.BB_RANK_1)
+
+    single = _shift(pawns, forward) & empty
+    targets = [
+        single & mask,
+        _shift(single & start_rank, forward) & empty & mask,
+    ]
+    targets += [_shift(pawns, offset) & ~edge & enemies & mask for offset, edge in _PAWN_CAPTURE_SHIFTS[color]]
+    result = [(bb, 1) for bb in targets if bb]
+    result += [(bb & last_rank, 3) for bb in targets if bb & last_rank]
+    return result
+
+
+def _fill_mobility_plane(board, planes):
     # 28: Movilidad (número de movimientos legales por casilla)
-    mobility = np.zeros((8, 8))
-    for move in board.legal_moves:
-        to_sq = move.to_square
-        i_to, j_to = 7 - chess.square_rank(to_sq), chess.square_file(to_sq)
-        mobility[i_to, j_to] += 1
+    # Se cuentan los destinos con bitboards; con jaque (o sin rey) se
+    # recorre board.legal_moves, que es donde la lógica de evasión importa.
+    color = board.turn
+    king = board.king(color)
+    if king is None or board.checkers_mask():
+        mobility = np.zeros((8, 8))
+        for move in board.legal_moves:
+            to_sq = move.to_square
+            i_to, j_to = 7 - chess.square_rank(to_sq), chess.square_file(to_sq)
+            mobility[i_to, j_to] += 1
+        planes[:, :, 28] = np.tanh(mobility / 10)
+        return
+
+    ours = board.occupied_co[color]
+    targets = []
+
+    # Piezas clavadas: solo pueden estar en las líneas que salen del rey
+    pins = {}
+    for sq in chess.scan_forward(ours & _QUEEN_LINES[king]):
+        pin = board.pin_mask(color, sq)
+        if pin != chess.BB_ALL:
+            pins[sq] = pin
+    pinned = sum(chess.BB_SQUARES[sq] for sq in pins)
+
+    # Peones sin clavar, todos a la vez; los clavados solo a lo largo de la clavada
+    pawns = board.pawns & ours
+    targets += _pawn_move_targets(board, pawns & ~pinned, color)
+    for sq in chess.scan_forward(pawns & pinned):
+        targets += _pawn_move_targets(board, chess.BB_SQUARES[sq], color, pins[sq])
+
+    # Piezas: sus ataques a casillas no propias
+    for sq in chess.scan_forward(ours & ~board.pawns & ~board.kings):
+        bb = board.attacks_mask(sq) & ~ours & pins.get(sq, chess.BB_ALL)
+        if bb:
+            targets.append((bb, 1))
+
+    # Rey: casillas no propias que el rival no ataca
+    attacked = 0
+    for bb in _attack_bitboards(board, not color):
+        attacked |= bb
+    targets.append((chess.BB_KING_ATTACKS[king] & ~ours & ~attacked, 1))
+
+    # Enroques y al paso: pocos movimientos, se generan tal cual
+    for move in board.generate_castling_moves():
+        targets.append((chess.BB_SQUARES[move.to_square], 1))
+    for move in board.generate_legal_ep():
+        targets.append((chess.BB_SQUARES[move.to_square], 1))
+
+    mobility = _square_counts([bb for bb, _ in targets], [w for _, w in targets])
     planes[:, :, 28] = np.tanh(mobility / 10)
-    
-    return planes
\ No newline at end of file
@@ -0,0 +1,186 @@
+# src/conversor/compressed_pgn.py
+"""
+Lectura en streaming de PGN comprimidos (.pgn.zst, .pgn.bz2, .pgn.gz).
+
+Los volcados mensuales de la base de datos de Lichess ocupan varios GB
+comprimidos con zstd y mucho más descomprimidos. open_pgn los abre como
+un archivo binario normal (read, readline, seek, tell) que descomprime
+sobre la marcha, así que el índice de partidas y la lectura por rangos de
+pgn_stream funcionan igual, con los bytes contados sobre el texto
+descomprimido. No se escribe nada descomprimido en disco.
+
+Un archivo comprimido puede tener varios frames (zstd), miembros (gzip,
+p. ej. bgzip) o streams (bz2, p. ej. pbzip2) independientes. Al leerlo
+entero se anotan como puntos de acceso (byte comprimido, byte
+descomprimido) donde se puede empezar a descomprimir de cero. seek()
+arranca desde el último punto conocido antes del destino y descarta lo
+que sobre. Por eso la ingesta solo reparte un comprimido entre workers
+por esos puntos: cada uno empieza a leer en el frame que le toca. Con un
+solo frame (lo habitual en zstd) saltar a un rango obliga a descomprimir
+desde el principio, así que el archivo lo lee entero un solo worker, de
+corrido, con el mismo archivo abierto para todos sus rangos.
+
+zstd necesita el paquete `zstandard` (solo para los .zst).
+"""
+
+import bisect
+import bz2
+import io
+import zlib
+from pathlib import Path
+
+COMPRESSION_SUFFIXES = {".zst": "zstd", ".bz2": "bz2", ".gz": "gzip"}
+PGN_SUFFIXES = (".pgn",) + tuple(".pgn" + suffix for suffix in COMPRESSION_SUFFIXES)
+READ_BYTES = 1024 * 1024  # Bloque de lectura del archivo comprimido
+
+# Puntos de acceso conocidos de cada archivo (ruta absoluta → [(comprimido, descomprimido)])
+_seek_points = {}
+
+
+def compression_of(path) -> str:
+    """Tipo de compresión según la extensión ("zstd", "bz2", "gzip") o None."""
+    return COMPRESSION_SUFFIXES.get(Path(path).suffix.lower())
+
+
+def is_pgn_file(path) -> bool:
+    return Path(path).name.lower().endswith(PGN_SUFFIXES)
+
+
+def pgn_stem(path) -> str:
+    """Nombre sin extensiones: "jugador_blitz.pgn.zst" → "jugador_blitz"."""
+    name = Path(path).name
+    if compression_of(name):
+        name = name[:-len(Path(name).suffix)]
+    return Path(name).stem
+
+
+def _decompressor(kind: str):
+    """Descompresor de un solo frame / miembro / stream (con .eof y .unused_data)."""
+    if kind == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if kind == "bz2":
+        return bz2.BZ2Decompressor()
+    if kind == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Para leer .pgn.zst hace falta el paquete zstandard (pip install zstandard)") from e
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Compresión desconocida: {kind!r}")
+
+
+def remember_seek_points(path, points):
+    """Registra los puntos de acceso de `path` para los open_pgn de este proceso."""
+    _seek_points[str(Path(path).resolve())] = sorted({(int(c), int(u)) for c, u in points})
+
+
+def known_seek_points(path) -> list:
+    """Puntos de acceso registrados para `path` en este proceso (solo (0, 0) si ninguno)."""
+    return _seek_points.get(str(Path(path).resolve()), [(0, 0)])
+
+
+def seek_points_of(handle) -> list:
+    """Puntos de acceso descubiertos por un archivo abierto con open_pgn ([] si no está comprimido)."""
+    raw = getattr(handle, "raw", None)
+    return list(raw.seek_points) if isinstance(raw, _DecompressedRaw) else []
+
+
+class _DecompressedRaw(io.RawIOBase):
+    """Flujo descomprimido de un archivo, con seek por puntos de acceso + descarte."""
+
+    def __init__(self, path, kind: str, seek_points=None):
+        self._file = open(path, "rb")
+        self.kind = kind
+        self.seek_points = sorted(set(seek_points or []) | {(0, 0)})
+        self._restart(0, 0)
+
+    def _restart(self, compressed: int, position: int):
+        self._file.seek(compressed)
+        self._compressed = compressed  # byte comprimido de lo siguiente por leer
+        self._position = position      # byte descomprimido de lo siguiente por devolver
+        self._decoder = _decompressor(self.kind)
+        self._pending = b""
+        self._offset = 0               # lo ya devuelto de _pending
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _fill(self):
+        """Descomprime el siguiente bloque en _pending; anota los finales de frame."""
+        data = self._file.read(READ_BYTES)
+        if not data:
+            self._eof = True
+            return
+        produced = len(self._pending) - self._offset
+        out = []
+        while data:
+            consumed = len(data)
+            out.append(self._decoder.decompress(data))
+            produced += len(out[-1])
+            if not self._decoder.eof:
+                self._compressed += consumed
+                break
+            unused = self._decoder.unused_data
+            data = unused.lstrip(b"\0")  # relleno entre miembros (gzip) o al final
+            self._compressed += consumed - len(data)
+            point = (self._compressed, self._position + produced)
+            if point not in self.seek_points:
+                bisect.insort(self.seek_points, point)
+            self._decoder = _decompressor(self.kind)
+        self._pending = self._pending[self._offset:] + b"".join(out)
+        self._offset = 0
+
+    def readinto(self, buffer) -> int:
+        while self._offset >= len(self._pending) and not self._eof:
+            self._fill()
+        n = min(len(buffer), len(self._pending) - self._offset)
+        buffer[:n] = self._pending[self._offset:self._offset + n]
+        self._offset += n
+        self._position += n
+        return n
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Solo se puede buscar desde el principio o la posición actual")
+        # Último punto de acceso antes del destino: si está más allá de donde
+        # estamos (o hay que volver atrás), se empieza a descomprimir ahí
+        compressed, position = self.seek_points[bisect.bisect_right(self.seek_points, offset, key=lambda p: p[1]) - 1]
+        if offset < self._position or position > self._position + len(self._pending) - self._offset:
+            self._restart(compressed, position)
+        while self._position < offset:
+            if self._offset >= len(self._pending):
+                if self._eof:
+                    break
+                self._fill()
+                continue
+            skip = min(offset - self._position, len(self._pending) - self._offset)
+            self._offset += skip
+            self._position += skip
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_pgn(path):
+    """
+    Abre un PGN (comprimido o no) en modo binario. Los comprimidos se
+    descomprimen en streaming y usan los puntos de acceso registrados con
+    remember_seek_points (o los que vayan descubriendo).
+    """
+    kind = compression_of(path)
+    if kind is None:
+        return open(path, "rb")
+    points = _seek_points.get(str(Path(path).resolve()))
+    return io.BufferedReader(_DecompressedRaw(path, kind, points), buffer_size=READ_BYTES)
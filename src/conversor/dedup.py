@@ -0,0 +1,125 @@
+# src/conversor/dedup.py
+"""
+Deduplicación de posiciones en todo el corpus.
+
+Las aperturas se repiten miles de veces entre partidas y jugadores. Dos
+registros son el mismo si coinciden el hash Zobrist de la posición y la
+jugada realizada: se guarda solo el primero, con un peso igual al número de
+veces que aparece, para usarlo como sample_weight en el entrenamiento.
+
+El hash no ve el historial (planos 20-21) ni el reloj de 50 movimientos,
+así que de cada grupo se conservan los planos de la primera aparición.
+
+Para que el dedup cubra también las tandas anteriores, junto al manifiesto
+se guarda un índice (DEDUP_INDEX_NAME) con la clave de cada registro ya
+repartido en shards con peso y dónde está (shard del manifiesto y fila). Un
+registro nuevo con una clave del índice no entra en ningún shard: se suma a
+la fila que ya existe (shards.add_shard_weights). Los shards escritos sin
+DEDUP no llevan peso y no entran en el índice.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.conversor.shards import load_shard, save_manifest
+
+DEDUP_INDEX_NAME = "dedup_index.npy"
+INDEX_DTYPE = np.dtype([("zobrist", "<u8"), ("move", "<u8"), ("shard", "<i4"), ("row", "<i4")])
+
+
+def move_codes(moves) -> np.ndarray:
+    """Jugadas UCI → uint64 (los bytes de la cadena), para ordenar sin objetos."""
+    moves = np.asarray(moves)
+    if moves.dtype == np.uint64:
+        return moves  # Ya codificadas (índice del corpus)
+    return np.asarray(moves).astype("S8").view("<u8").reshape(-1)
+
+
+def dedup_records(keys: list) -> list:
+    """
+    Agrupa los registros repetidos de varios archivos.
+
+    Args:
+        keys: lista con (hashes Zobrist uint64, jugadas UCI) de cada archivo.
+
+    Returns:
+        Lista paralela con (índices a conservar, pesos uint32) de cada
+        archivo: cada grupo se queda en su primera aparición (por orden de
+        archivo y de posición) con el total de apariciones como peso.
+    """
+    sizes = [len(zobrist) for zobrist, _ in keys]
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    if bounds[-1] == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32)) for _ in keys]
+    zobrist = np.concatenate([np.asarray(z, dtype=np.uint64) for z, _ in keys])
+    moves = np.concatenate([move_codes(m) for _, m in keys])
+
+    n = len(zobrist)
+    order = np.lexsort((np.arange(n), moves, zobrist))
+    z, m = zobrist[order], moves[order]
+    starts = np.flatnonzero(np.concatenate([[True], (z[1:] != z[:-1]) | (m[1:] != m[:-1])]))
+    first = order[starts]
+    counts = np.diff(np.concatenate([starts, [n]])).astype(np.uint32)
+
+    by_position = np.argsort(first)
+    first, counts = first[by_position], counts[by_position]
+    cuts = np.searchsorted(first, bounds)
+    return [(first[a:b] - bounds[i], counts[a:b]) for i, (a, b) in enumerate(zip(cuts[:-1], cuts[1:]))]
+
+
+def load_dedup_index(shard_dir) -> np.ndarray:
+    """Índice de claves de `shard_dir` (mapeado en memoria; vacío si no hay)."""
+    path = Path(shard_dir) / DEDUP_INDEX_NAME
+    if not path.exists():
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.load(path, mmap_mode="r")
+
+
+def save_dedup_index(shard_dir, index: np.ndarray):
+    """Escribe el índice de forma atómica (archivo temporal + rename)."""
+    path = Path(shard_dir) / DEDUP_INDEX_NAME
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, index, allow_pickle=False)
+    os.replace(tmp, path)
+
+
+def update_dedup_index(shard_dir, manifest: dict) -> np.ndarray:
+    """
+    Pone al día el índice con los shards del manifiesto que aún no cubre
+    (manifest["dedup_indexed"]) y lo devuelve. De cada shard con peso entran
+    las claves que no estaban ya en el índice; las repetidas (shards de antes
+    del índice) se quedan fuera, así que el índice no tiene claves repetidas
+    y volver a indexar un shard no cambia nada. Guarda el índice y el
+    manifiesto.
+    """
+    shard_dir = Path(shard_dir)
+    index = load_dedup_index(shard_dir)
+    shards = manifest["shards"]
+    start = manifest.get("dedup_indexed", 0)
+    if start >= len(shards):
+        return index
+
+    keys, owners = [], []
+    for i in range(start, len(shards)):
+        data = load_shard(shard_dir / shards[i]["path"], allow_pickle=True)
+        if "weight" in data and "zobrist" in data:
+            keys.append((np.asarray(data["zobrist"], dtype=np.uint64), move_codes(data["y"])))
+            owners.append(i)
+        if hasattr(data, "close"):
+            data.close()
+    if keys:
+        selections = dedup_records([(index["zobrist"], index["move"])] + keys)[1:]
+        added = [np.asarray(index)]
+        for shard, (zobrist, moves), (keep, _) in zip(owners, keys, selections):
+            rows = np.zeros(len(keep), dtype=INDEX_DTYPE)
+            rows["zobrist"], rows["move"] = zobrist[keep], moves[keep]
+            rows["shard"], rows["row"] = shard, keep
+            added.append(rows)
+        index = np.concatenate(added)
+        save_dedup_index(shard_dir, index)
+    manifest["dedup_indexed"] = len(shards)
+    save_manifest(shard_dir, manifest)
+    return index
@@ -0,0 +1,371 @@
+# src/conversor/pgn_stream.py
+"""
+Lectura de PGN en streaming.
+
+En lugar de leer el archivo entero y partirlo por "\n\n\n", se construye
+un índice con el byte donde empieza cada partida y luego se leen las
+partidas de una en una por su rango de bytes. La memoria del worker no
+depende del tamaño del PGN y, con el índice, se puede empezar (o retomar)
+en cualquier partida.
+
+Una partida empieza en una línea de cabecera ([Tag "valor"]) cuya línea
+anterior no es otra cabecera: sirve igual con una o varias líneas en
+blanco entre partidas, con CRLF o sin separador.
+
+Los .pgn.zst, .pgn.bz2 y .pgn.gz se leen descomprimiendo en streaming
+(ver compressed_pgn): los bytes del índice son los del texto descomprimido
+y junto al índice se guardan los puntos donde se puede empezar a
+descomprimir.
+
+Para la ingesta, MainlineVisitor codifica la línea principal mientras el
+parser la lee, sin construir el árbol de la partida.
+"""
+
+import io
+import os
+import re
+import tempfile
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+
+from src.conversor.board_representation import DEFAULT_FEATURE_SET, GameEncoder
+from src.conversor.compressed_pgn import (
+    compression_of, is_pgn_file, known_seek_points, open_pgn, remember_seek_points, seek_points_of
+)
+from src.conversor.stage_metrics import stage
+from src.move_encoding import canonical_uci
+
+INDEX_CHUNK_BYTES = 16 * 1024 * 1024  # Bloque de lectura al indexar
+INDEX_COPY_ROWS = 1 << 20             # Offsets copiados de una vez al escribir el índice
+INDEX_SUFFIX = ".idx.npy"
+SEEK_SUFFIX = ".seek.npy"  # Puntos de acceso (comprimido, descomprimido) de los PGN comprimidos
+
+# Límites (segundos estimados) de cada ritmo, como en Lichess
+_SPEED_LIMITS = (("ultrabullet", 30), ("bullet", 180), ("blitz", 480), ("rapid", 1500))
+
+_HEADER_LINE = re.compile(rb'^(?:\xef\xbb\xbf)?\[[A-Za-z0-9_]+[ \t]+"', re.MULTILINE)
+
+
+def _ends_header(line_end: bytes) -> bool:
+    """True si el final de línea dado es el de una cabecera (termina en "])."""
+    return line_end.rstrip(b"\r\n \t").endswith(b'"]')
+
+
+def find_pgn_files(directory) -> list:
+    """PGN de la carpeta, comprimidos o no (.pgn, .pgn.zst, .pgn.bz2, .pgn.gz)."""
+    return sorted(f for f in Path(directory).iterdir() if f.is_file() and is_pgn_file(f))
+
+
+def index_games(pgn_path, index_path=None) -> np.ndarray:
+    """
+    Recorre el PGN por bloques y devuelve un array int64 con el byte de
+    inicio de cada partida más el tamaño del archivo al final, de modo que
+    la partida i ocupa [offsets[i], offsets[i + 1]). En los comprimidos son
+    bytes del texto descomprimido, y los puntos de acceso encontrados se
+    registran con remember_seek_points (con el final del archivo como último).
+
+    Los inicios se van volcando a un archivo temporal bloque a bloque, así
+    que la memoria no depende del número de partidas (un volcado mensual
+    tiene ~100 millones). Con `index_path` el índice se escribe en ese .npy
+    y se devuelve mapeado (mmap_mode="r"); sin él, se devuelve en memoria.
+    """
+    pgn_path = Path(pgn_path)
+    index_path = Path(index_path) if index_path else None
+    prev_is_header = False  # ¿la última línea del bloque anterior era una cabecera?
+    base = 0                # byte del archivo donde empieza `data`
+    tail = b""
+    count, first = 0, None  # partidas encontradas y byte de la primera
+    with tempfile.TemporaryFile(dir=index_path.parent if index_path else None) as raw, open_pgn(pgn_path) as f:
+        while True:
+            block = f.read(INDEX_CHUNK_BYTES)
+            data = tail + block
+            cut = len(data) if not block else data.rfind(b"\n") + 1
+            text = data[:cut]
+            starts = []
+            for match in _HEADER_LINE.finditer(text):
+                start = match.start()
+                after_header = prev_is_header if start == 0 else _ends_header(text[max(0, start - 256):start])
+                if not after_header:
+                    starts.append(base + start)
+            if starts:
+                first = starts[0] if first is None else first
+                count += len(starts)
+                np.array(starts, dtype=np.int64).tofile(raw)
+            if text:
+                last_line = text[text.rfind(b"\n", 0, len(text) - 1) + 1:]
+                prev_is_header = _ends_header(last_line)
+            base += cut
+            tail = data[cut:]
+            if not block:
+                break
+        size = base
+        if compression_of(pgn_path):
+            remember_seek_points(pgn_path, seek_points_of(f) + [(pgn_path.stat().st_size, size)])
+
+        # Texto sin cabeceras antes de la primera: también es una partida
+        lead = []
+        if first is None or first > 0:
+            f.seek(0)
+            prefix = f.read(first if first is not None else size)
+            if prefix.lstrip(b"\xef\xbb\xbf").strip():
+                lead = [0]
+
+        raw.flush()
+        shape = (len(lead) + count + 1,)
+        if index_path is None:
+            offsets = np.empty(shape, dtype=np.int64)
+        else:
+            tmp_path = index_path.with_name(index_path.name + ".tmp")
+            offsets = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int64, shape=shape)
+        offsets[:len(lead)] = lead
+        offsets[-1] = size
+        if count:
+            starts = np.memmap(raw, dtype=np.int64, mode="r", shape=(count,))
+            for i in range(0, count, INDEX_COPY_ROWS):
+                offsets[len(lead) + i:len(lead) + min(i + INDEX_COPY_ROWS, count)] = starts[i:i + INDEX_COPY_ROWS]
+            del starts
+    if index_path is None:
+        return offsets
+    offsets.flush()
+    del offsets
+    os.replace(tmp_path, index_path)
+    return np.load(index_path, mmap_mode="r")
+
+
+def load_game_index(pgn_path, index_dir=None) -> np.ndarray:
+    """
+    Índice de partidas del PGN (ver index_games), guardado en `index_dir`
+    (por defecto junto al PGN) para no recorrer el archivo otra vez. Se
+    reconstruye si el tamaño del archivo ya no coincide. Se devuelve
+    mapeado en memoria (mmap_mode="r"): abrirlo no carga los offsets en RAM.
+    Construirlo se mide como la etapa "index" (abrir uno ya hecho, no).
+    En los comprimidos guarda también los puntos de acceso (SEEK_SUFFIX) y
+    los registra para los open_pgn de este proceso.
+    """
+    pgn_path = Path(pgn_path)
+    index_path = Path(index_dir or pgn_path.parent) / (pgn_path.name + INDEX_SUFFIX)
+    seek_path = index_path.with_name(pgn_path.name + SEEK_SUFFIX)
+    compressed = compression_of(pgn_path) is not None
+    size = pgn_path.stat().st_size
+    if index_path.exists():
+        try:
+            offsets = np.load(index_path, mmap_mode="r")
+            if not compressed:
+                if len(offsets) and offsets[-1] == size:
+                    return offsets
+            else:
+                points = np.load(seek_path)
+                # El último punto es (tamaño comprimido, tamaño descomprimido)
+                if len(offsets) and len(points) and tuple(points[-1]) == (size, offsets[-1]):
+                    remember_seek_points(pgn_path, points)
+                    return offsets
+        except (OSError, ValueError):
+            pass
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with stage("index", pgn_path.name, bytes_in=size) as counters:
+        offsets = index_games(pgn_path, index_path)
+        counters["games"] = len(offsets) - 1
+    if compressed:
+        np.save(seek_path, np.array(known_seek_points(pgn_path), dtype=np.int64))
+    return offsets
+
+
+def _opened(pgn_path, handle):
+    """`handle` tal cual (sin cerrarlo al salir) o el PGN recién abierto con open_pgn."""
+    return nullcontext(handle) if handle is not None else open_pgn(pgn_path)
+
+
+def iter_game_texts(pgn_path, offsets=None, start: int = 0, stop: int = None, games=None, handle=None):
+    """
+    Genera (número de partida, texto PGN) de las partidas [start, stop), o
+    solo de las de `games` (números en orden, p. ej. de select_games),
+    leyendo cada una por su rango de bytes. Solo hay una partida en memoria.
+    Con `handle` (un open_pgn ya abierto) se lee de él sin cerrarlo: con
+    rangos consecutivos, un comprimido sigue descomprimiendo donde lo dejó.
+    """
+    if offsets is None:
+        offsets = load_game_index(pgn_path)
+    num_games = len(offsets) - 1
+    stop = num_games if stop is None else min(stop, num_games)
+    if games is None:
+        games = range(start, stop)
+    if len(games) == 0:
+        return
+    with _opened(pgn_path, handle) as f:
+        position = -1
+        for i in games:
+            i = int(i)
+            if offsets[i] != position:
+                f.seek(int(offsets[i]))
+            raw = f.read(int(offsets[i + 1] - offsets[i]))
+            position = offsets[i + 1]
+            yield i, raw.decode("utf-8", errors="replace")
+
+
+def read_game_headers(pgn_path, offsets=None, start: int = 0, stop: int = None, handle=None):
+    """
+    Genera (número de partida, chess.pgn.Headers) de las partidas [start, stop)
+    leyendo solo las líneas de cabecera de cada una, sin tocar los movimientos.
+    `handle` como en iter_game_texts.
+    """
+    if offsets is None:
+        offsets = load_game_index(pgn_path)
+    stop = len(offsets) - 1 if stop is None else min(stop, len(offsets) - 1)
+    with _opened(pgn_path, handle) as f:
+        for i in range(start, stop):
+            f.seek(int(offsets[i]))
+            end = offsets[i + 1]
+            lines = []
+            while f.tell() < end:
+                line = f.readline().lstrip(b"\xef\xbb\xbf")
+                if line.startswith(b"["):
+                    lines.append(line)
+                elif line.strip() or lines:
+                    break
+            headers = chess.pgn.read_headers(io.StringIO(b"".join(lines).decode("utf-8", errors="replace")))
+            yield i, headers if headers is not None else chess.pgn.Headers()
+
+
+def select_games(pgn_path, predicate, offsets=None, start: int = 0, stop: int = None, handle=None) -> np.ndarray:
+    """Números de las partidas [start, stop) cuyas cabeceras cumplen `predicate(headers)`."""
+    headers = read_game_headers(pgn_path, offsets, start, stop, handle=handle)
+    return np.array([i for i, h in headers if predicate(h)], dtype=np.int64)
+
+
+def speed_from_time_control(time_control: str) -> str:
+    """
+    Ritmo de la partida a partir de la cabecera TimeControl ("180+2"), como
+    en Lichess: duración estimada = base + 40 × incremento.
+    """
+    if time_control == "-":
+        return "correspondence"
+    try:
+        base, _, increment = time_control.partition("+")
+        duration = int(base) + 40 * int(increment or 0)
+    except ValueError:
+        return "unknown"
+    for speed, limit in _SPEED_LIMITS:
+        if duration < limit:
+            return speed
+    return "classical"
+
+
+def _elo(headers, tag) -> int:
+    try:
+        return int(headers.get(tag, ""))
+    except ValueError:
+        return -1
+
+
+class HeaderFilter:
+    """
+    Filtro de partidas por cabecera, para descartarlas antes de parsearlas.
+
+    Args:
+        min_elo: Elo mínimo de ambos jugadores (sin Elo cuenta como no llegar).
+        speeds: ritmos admitidos ("bullet", "blitz", ...; ver speed_from_time_control).
+        results: resultados admitidos, p. ej. {"1-0", "0-1"} para solo decisivas.
+        exclude_terminations: valores de Termination descartados, p. ej. {"Abandoned"}.
+    Los criterios a None (o vacíos) no filtran.
+    """
+
+    def __init__(self, min_elo: int = None, speeds=None, results=None, exclude_terminations=()):
+        self.min_elo = min_elo
+        self.speeds = set(speeds) if speeds else None
+        self.results = set(results) if results else None
+        self.exclude_terminations = set(exclude_terminations or ())
+
+    @property
+    def active(self) -> bool:
+        return bool(self.min_elo is not None or self.speeds or self.results or self.exclude_terminations)
+
+    def __call__(self, headers) -> bool:
+        if self.min_elo is not None and min(_elo(headers, "WhiteElo"), _elo(headers, "BlackElo")) < self.min_elo:
+            return False
+        if self.speeds and speed_from_time_control(headers.get("TimeControl", "")) not in self.speeds:
+            return False
+        if self.results and headers.get("Result", "*") not in self.results:
+            return False
+        if headers.get("Termination") in self.exclude_terminations:
+            return False
+        return True
+
+
+def iter_games(pgn_path, offsets=None, start: int = 0, stop: int = None):
+    """Como iter_game_texts pero genera (número, chess.pgn.Game); se saltan las ilegibles."""
+    for i, text in iter_game_texts(pgn_path, offsets, start, stop):
+        game = chess.pgn.read_game(io.StringIO(text))
+        if game is not None:
+            yield i, game
+
+
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    """
+    Visitor de chess.pgn que solo sigue la línea principal: salta las
+    variantes, ignora comentarios y NAG, y codifica cada posición en `arena`
+    (un PlaneArena) antes de cada movimiento, sobre el mismo tablero en el
+    que el parser juega los movimientos. result() devuelve las jugadas UCI
+    (reflejadas con negras al turno si canonical) y `headers` guarda las
+    cabeceras. Con hashes=True guarda además en `hashes` el hash Zobrist de
+    cada posición codificada (la reflejada en modo canónico), para dedup.
+    `encode_seconds` acumula el tiempo pasado codificando (el resto es parseo).
+
+    Si aparece un movimiento ilegal se para ahí, como read_game, que deja
+    la partida hasta el error.
+
+    Uso:
+        y = chess.pgn.read_game(handle, Visitor=lambda: MainlineVisitor(arena))
+    """
+
+    def __init__(self, arena, feature_set=DEFAULT_FEATURE_SET, cache=None, canonical: bool = False,
+                 hashes: bool = False):
+        self.arena = arena
+        self.feature_set = feature_set
+        self.cache = cache
+        self.canonical = canonical
+        self.headers = {}
+        self.moves = []
+        self.hashes = [] if hashes else None
+        self.errors = []
+        self.encode_seconds = 0.0
+        self._encoder = None
+        self._pending = None
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def visit_board(self, board: chess.Board):
+        start = time.perf_counter()
+        if self._encoder is None:
+            self._encoder = GameEncoder(board, feature_set=self.feature_set, cache=self.cache,
+                                        canonical=self.canonical, copy_board=False)
+        elif self._pending is not None:
+            self._encoder.update(self._pending)
+            self._pending = None
+        self.encode_seconds += time.perf_counter() - start
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        start = time.perf_counter()
+        out = self.arena.reserve(1)
+        self._encoder.encode(out=out[0])
+        self.arena.commit(1)
+        self.encode_seconds += time.perf_counter() - start
+        self.moves.append(canonical_uci(move.uci(), board.turn) if self.canonical else move.uci())
+        if self.hashes is not None:
+            self.hashes.append(chess.polyglot.zobrist_hash(self._encoder.encoded_board))
+        self._pending = move
+
+    def handle_error(self, error: Exception):
+        self.errors.append(error)
+
+    def result(self):
+        return self.moves
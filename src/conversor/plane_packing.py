@@ -0,0 +1,273 @@
+# src/conversor/plane_packing.py
+"""
+Formato compacto en disco para los planos 8x8x29.
+
+Un array float32 (8, 8, 29) ocupa 7.424 bytes, pero casi todo es redundante:
+- Los planos binarios por casilla (piezas 0-11, al paso 17, últimos
+  movimientos 20-21, desarrollo 26) caben en un bitboard uint64 cada uno.
+- La estructura de peones (25) solo vale 0, 0.5 o 1.0: dos bitboards más.
+- Los planos constantes binarios (12-16 salvo el 17, 18, 19) son 7 bits.
+- Las distancias de los reyes (22-23) son dos escalares por posición.
+- El mapa de ataques (27) y la movilidad (28) son tanh de enteros pequeños:
+  se guarda el entero (int8 / uint8) y se recupera con una tabla, sin
+  pérdida. El control del centro (24) sale del mismo entero que el 27.
+
+En total unos 281 bytes por posición (~26x menos) y la decodificación es
+exacta: unpack_planes(pack_planes(X)) == X bit a bit.
+"""
+
+import numpy as np
+
+# Identificador guardado en los .npz empaquetados
+PACKED_FORMAT = "packed-v1"
+
+# Claves de los arrays empaquetados dentro del .npz
+PACKED_KEYS = ("bitboards", "flags", "scalars", "attacks", "mobility")
+
+# Planos binarios por casilla, en el orden de la columna de bitboards
+_BINARY_PLANES = list(range(12)) + [17, 20, 21, 26]
+# Detrás van dos bitboards para el plano 25: peones doblados (0.5) y pasados (1.0)
+_NUM_BITBOARDS = len(_BINARY_PLANES) + 2
+
+# Planos constantes binarios → bit del campo `flags`
+_FLAG_PLANES = [12, 13, 14, 15, 16, 18, 19]
+# Planos constantes con valor real → columna de `scalars`
+_SCALAR_PLANES = [22, 23]
+
+# Casillas del control del centro (d4, d5, e4, e5) como (fila, columna) del plano
+_CENTER_CELLS = [(4, 3), (3, 3), (4, 4), (3, 4)]
+_CENTER_MASK = np.zeros((8, 8), dtype=bool)
+for _i, _j in _CENTER_CELLS:
+    _CENTER_MASK[_i, _j] = True
+
+# Tablas exactas de los planos con tanh: mismo cálculo que el codificador
+# (float64 → float32), indexadas por el entero original.
+_ATTACK_RANGE = 32
+_ATTACK_TABLE = np.tanh(np.arange(-_ATTACK_RANGE, _ATTACK_RANGE + 1) / 5).astype(np.float32)
+_CENTER_TABLE = np.tanh(np.arange(-_ATTACK_RANGE, _ATTACK_RANGE + 1) / 3).astype(np.float32)
+_MOBILITY_RANGE = 64
+_MOBILITY_TABLE = np.tanh(np.arange(_MOBILITY_RANGE) / 10).astype(np.float32)
+
+
+def _planes_to_bitboards(masks: np.ndarray) -> np.ndarray:
+    """(N, 8, 8, P) booleanos → (N, P) uint64, con la fila 0 = rango 8."""
+    n, p = masks.shape[0], masks.shape[-1]
+    ranks = masks.transpose(0, 3, 1, 2)[:, :, ::-1, :]
+    packed = np.packbits(ranks, axis=-1, bitorder='little')  # (N, P, 8, 1)
+    return np.ascontiguousarray(packed.reshape(n, p, 8)).view('<u8').reshape(n, p)
+
+
+def _bitboards_to_bits(bitboards: np.ndarray) -> np.ndarray:
+    """(N, P) uint64 → (N, 8, 8, P) de 0/1 (uint8)."""
+    n, p = bitboards.shape
+    raw = np.ascontiguousarray(bitboards, dtype='<u8').view(np.uint8).reshape(n, p, 8)
+    bits = np.unpackbits(raw, axis=-1, bitorder='little').reshape(n, p, 8, 8)
+    return bits[:, :, ::-1, :].transpose(0, 2, 3, 1)
+
+
+def _table_index(values: np.ndarray, table: np.ndarray, plane: int) -> np.ndarray:
+    idx = np.clip(np.searchsorted(table, values), 0, len(table) - 1)
+    if not np.array_equal(table[idx], values):
+        raise ValueError(f"El plano {plane} tiene valores fuera de la tabla; no se puede empaquetar sin pérdida")
+    return idx
+
+
+def pack_planes(X: np.ndarray) -> dict:
+    """
+    Empaqueta un array (N, 8, 8, 29) en el formato compacto.
+
+    Returns:
+        dict con los arrays de PACKED_KEYS, listo para np.savez(**packed).
+    """
+    X = np.asarray(X)
+    if X.ndim != 4 or X.shape[1:] != (8, 8, 29):
+        raise ValueError(f"Se esperaba un array (N, 8, 8, 29), llegó {X.shape}")
+    n = X.shape[0]
+
+    pawn_structure = X[..., 25]
+    masks = np.concatenate([
+        X[..., _BINARY_PLANES] != 0,
+        (pawn_structure == 0.5)[..., None],
+        (pawn_structure == 1.0)[..., None],
+    ], axis=-1)
+    bitboards = _planes_to_bitboards(masks)
+
+    flags = np.zeros(n, dtype=np.uint8)
+    for bit, plane in enumerate(_FLAG_PLANES):
+        flags |= (X[:, 0, 0, plane] != 0).astype(np.uint8) << bit
+
+    scalars = X[:, 0, 0, _SCALAR_PLANES].astype(np.float32)
+
+    attacks = _table_index(X[..., 27].reshape(n, 64), _ATTACK_TABLE, 27) - _ATTACK_RANGE
+    mobility = _table_index(X[..., 28].reshape(n, 64), _MOBILITY_TABLE, 28)
+
+    return {
+        "bitboards": bitboards,
+        "flags": flags,
+        "scalars": scalars,
+        "attacks": attacks.astype(np.int8),
+        "mobility": mobility.astype(np.uint8),
+    }
+
+
+def unpack_planes(packed, out: np.ndarray = None) -> np.ndarray:
+    """
+    Reconstruye el array (N, 8, 8, 29) float32 a partir del formato compacto.
+    `packed` puede ser el dict de pack_planes o el NpzFile cargado.
+    """
+    bitboards = np.asarray(packed["bitboards"])
+    n = bitboards.shape[0]
+    if out is None:
+        out = np.zeros((n, 8, 8, 29), dtype=np.float32)
+    else:
+        out[:n] = 0
+        out = out[:n]
+
+    bits = _bitboards_to_bits(bitboards)
+    out[..., _BINARY_PLANES] = bits[..., :len(_BINARY_PLANES)]
+    out[..., 25] = 0.5 * bits[..., -2] + bits[..., -1]
+
+    flags = np.asarray(packed["flags"])
+    for bit, plane in enumerate(_FLAG_PLANES):
+        out[..., plane] = ((flags >> bit) & 1)[:, None, None]
+    out[..., _SCALAR_PLANES] = np.asarray(packed["scalars"])[:, None, None, :]
+
+    attacks = np.asarray(packed["attacks"]).astype(np.intp) + _ATTACK_RANGE
+    out[..., 27] = _ATTACK_TABLE[attacks].reshape(n, 8, 8)
+    for i, j in _CENTER_CELLS:
+        out[:, i, j, 24] = _CENTER_TABLE[attacks[:, i * 8 + j]]
+    out[..., 28] = _MOBILITY_TABLE[np.asarray(packed["mobility"])].reshape(n, 8, 8)
+    return out
+
+
+def bitboard_bytes(bitboards: np.ndarray) -> np.ndarray:
+    """Vista (N, 18, 8) uint8 de los bitboards, para tf_unpack_planes (sin copia)."""
+    return np.ascontiguousarray(bitboards, dtype='<u8').view(np.uint8).reshape(-1, _NUM_BITBOARDS, 8)
+
+
+# === Cuantización a 8 bits (uint8) ===
+# Planos que pueden ser negativos (tanh de una diferencia de atacantes):
+# [-1, 1] → [0, 254] con el 0 en 127. El resto va de [0, 1] a [0, 254].
+# Con 254 pasos 0, 0.5 y 1.0 son exactos, así que todos los planos binarios y
+# la estructura de peones no pierden nada; el error máximo del resto es
+# 1/508 (positivos) o 1/254 (con signo).
+SIGNED_PLANES = (24, 27)
+_UNSIGNED_SCALE = 254.0
+_SIGNED_SCALE = 127.0
+
+# Tipos admitidos para los planos en memoria y en disco
+PLANE_DTYPES = ("float32", "float16", "uint8")
+
+
+def quantization_params(planes=tuple(range(29))):
+    """Escala y desplazamiento por canal: q = x * scale + offset."""
+    scale = np.array([_SIGNED_SCALE if p in SIGNED_PLANES else _UNSIGNED_SCALE for p in planes], dtype=np.float32)
+    offset = np.array([_SIGNED_SCALE if p in SIGNED_PLANES else 0.0 for p in planes], dtype=np.float32)
+    return scale, offset
+
+
+def quantize_planes(X: np.ndarray, planes=tuple(range(29)), out: np.ndarray = None) -> np.ndarray:
+    """Planos reales (..., len(planes)) → uint8. `planes` indica qué plano es cada canal."""
+    scale, offset = quantization_params(planes)
+    q = np.rint(np.asarray(X, dtype=np.float32) * scale + offset)
+    if out is None:
+        return q.astype(np.uint8)
+    out[...] = q
+    return out
+
+
+def dequantize_planes(Q: np.ndarray, planes=tuple(range(29)), dtype=np.float32) -> np.ndarray:
+    """Inverso de quantize_planes."""
+    scale, offset = quantization_params(planes)
+    return ((np.asarray(Q, dtype=np.float32) - offset) / scale).astype(dtype)
+
+
+def convert_planes(X: np.ndarray, dtype, planes=tuple(range(29))) -> np.ndarray:
+    """Convierte planos entre float32, float16 y uint8 (cuantizado)."""
+    dtype = np.dtype(dtype)
+    if dtype.name not in PLANE_DTYPES:
+        raise ValueError(f"Tipo de planos no soportado: {dtype}. Opciones: {PLANE_DTYPES}")
+    X = np.asarray(X)
+    if X.dtype == dtype:
+        return X
+    if dtype == np.uint8:
+        return quantize_planes(X, planes)
+    if X.dtype == np.uint8:
+        return dequantize_planes(X, planes, dtype)
+    return X.astype(dtype)
+
+
+def tf_convert_planes(x, dtype, planes=tuple(range(29))):
+    """Versión TensorFlow de convert_planes para planos float32 (p. ej. tras tf_unpack_planes)."""
+    import tensorflow as tf
+
+    if dtype in ("uint8", np.uint8):
+        scale, offset = quantization_params(planes)
+        return tf.cast(tf.round(x * scale + offset), tf.uint8)
+    return tf.cast(x, dtype)
+
+
+def is_packed(data) -> bool:
+    """True si un .npz cargado usa el formato compacto."""
+    return "bitboards" in data
+
+
+def num_positions(data) -> int:
+    """Número de posiciones de un .npz, denso ('X') o empaquetado."""
+    return len(data["bitboards"]) if is_packed(data) else len(data["X"])
+
+
+def tf_unpack_planes(bitboard_bytes, flags, scalars, attacks, mobility):
+    """
+    Versión TensorFlow de unpack_planes para usar en el map() de tf.data,
+    sobre lotes ya agrupados con .batch().
+
+    Args:
+        bitboard_bytes: (B, 18, 8) uint8 — los bitboards vistos como bytes
+            (ver bitboard_bytes()).
+        flags: (B,) uint8.
+        scalars: (B, 2) float32.
+        attacks: (B, 64) int8.
+        mobility: (B, 64) uint8.
+
+    Returns:
+        tf.Tensor (B, 8, 8, 29) float32.
+    """
+    import tensorflow as tf
+
+    shifts = tf.constant(np.arange(8, dtype=np.uint8))
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(bitboard_bytes[..., None], shifts), 1)
+    # (B, P, rango, columna) → (B, fila, columna, P) con la fila 0 = rango 8
+    bits = tf.transpose(tf.reverse(tf.cast(bits, tf.float32), axis=[2]), [0, 2, 3, 1])
+
+    batch = tf.shape(flags)[0]
+    ones = tf.ones((batch, 8, 8), dtype=tf.float32)
+
+    def constant(values):
+        return ones * tf.cast(values, tf.float32)[:, None, None]
+
+    flag_bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(flags[:, None], shifts[:len(_FLAG_PLANES)]), 1)
+    attack_idx = tf.cast(attacks, tf.int32) + _ATTACK_RANGE
+    attack_plane = tf.reshape(tf.gather(_ATTACK_TABLE, attack_idx), (batch, 8, 8))
+    center_values = tf.reshape(tf.gather(_CENTER_TABLE, attack_idx), (batch, 8, 8))
+    mobility_plane = tf.reshape(tf.gather(_MOBILITY_TABLE, tf.cast(mobility, tf.int32)), (batch, 8, 8))
+
+    binary = {plane: bits[..., k] for k, plane in enumerate(_BINARY_PLANES)}
+    flag_planes = {plane: constant(flag_bits[:, bit]) for bit, plane in enumerate(_FLAG_PLANES)}
+    channels = []
+    for plane in range(29):
+        if plane in binary:
+            channels.append(binary[plane])
+        elif plane in flag_planes:
+            channels.append(flag_planes[plane])
+        elif plane in _SCALAR_PLANES:
+            channels.append(constant(scalars[:, _SCALAR_PLANES.index(plane)]))
+        elif plane == 24:
+            channels.append(tf.where(_CENTER_MASK, center_values, tf.zeros_like(center_values)))
+        elif plane == 25:
+            channels.append(0.5 * bits[..., -2] + bits[..., -1])
+        elif plane == 27:
+            channels.append(attack_plane)
+        else:
+            channels.append(mobility_plane)
+    return tf.stack(channels, axis=-1)
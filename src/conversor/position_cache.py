@@ -0,0 +1,103 @@
+# src/conversor/position_cache.py
+"""
+Caché LRU de posiciones ya codificadas.
+
+Las aperturas se repiten miles de veces entre partidas y jugadores, así que
+las primeras jugadas de casi todas las partidas ya se han codificado antes.
+La clave es el hash Zobrist (piezas, turno, enroques y al paso) más lo que
+el hash no ve y sí cambia los planos: la regla de 50 movimientos (plano 19)
+y las casillas de los dos últimos movimientos (planos 20-21).
+
+Cada proceso tiene su propia caché; el mismo objeto sirve para los
+codificadores de la ingesta y para cualquier camino de inferencia.
+"""
+
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+import numpy as np
+
+
+class PositionCache:
+    """
+    Caché LRU acotada de planos (8, 8, 29) indexada por posición.
+
+    Args:
+        max_entries: número máximo de posiciones guardadas (~7 KB cada una).
+        max_ply: solo se guardan posiciones hasta esta media jugada
+            (None = todas). Limitarla a la apertura evita llenar la caché
+            de posiciones de medio juego que no se van a repetir.
+    """
+
+    def __init__(self, max_entries: int = 20000, max_ply: int = None):
+        if max_entries <= 0:
+            raise ValueError("max_entries debe ser mayor que 0")
+        self.max_entries = max_entries
+        self.max_ply = max_ply
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, board: chess.Board, last_moves, groups) -> tuple:
+        """
+        Clave de la posición. `last_moves` son los movimientos previos (UCI o
+        chess.Move) y `groups` los grupos de planos calculados, para que dos
+        codificadores con distintos conjuntos de planos no se mezclen.
+        Devuelve None si la posición no se cachea.
+        """
+        if self.max_ply is not None and board.ply() > self.max_ply:
+            return None
+        recent = []
+        for move in (last_moves or [])[-2:]:
+            if isinstance(move, str):
+                try:
+                    move = chess.Move.from_uci(move)
+                except ValueError:
+                    return None
+            recent.append((move.from_square, move.to_square))
+        return (chess.polyglot.zobrist_hash(board), board.halfmove_clock >= 50, tuple(recent), groups)
+
+    def get(self, key) -> np.ndarray:
+        """Planos guardados para `key`, o None (y cuenta el fallo)."""
+        if key is None:
+            return None
+        planes = self._entries.get(key)
+        if planes is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return planes
+
+    def put(self, key, planes: np.ndarray):
+        """Guarda una copia de `planes`, expulsando la entrada menos usada si hace falta."""
+        if key is None:
+            return
+        self._entries[key] = planes.copy()
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """Estadísticas de uso: aciertos, fallos, tasa de acierto y ocupación."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
@@ -0,0 +1,223 @@
+# src/conversor/shards.py
+"""
+Salida de la ingesta en shards de tamaño fijo con un manifiesto.
+
+Los .npz por PGN tienen tamaños muy desiguales (de cientos a cientos de
+miles de posiciones). ShardWriter reparte las posiciones en shards de
+SHARD_SIZE posiciones por tipo de partida (bullet, blitz...) y anota cada
+uno en manifest.json: ruta, número de posiciones (y cuántas tienen una
+jugada no codificable), tipo de partida, PGN de origen y versión del
+codificador. El entrenamiento y las estadísticas
+pueden planificar con el manifiesto sin abrir ningún shard. Los orígenes
+que no aportan ninguna posición (p. ej. todas repetidas tras el dedup) se
+anotan aparte, en "empty_sources", para no volver a procesarlos.
+
+Hay dos formatos de shard:
+- "npz": un .npz comprimido. Ocupa menos, pero np.load tiene que
+  descomprimir cada array entero en RAM.
+- "npy": una carpeta con un .npy sin comprimir por array (y con las jugadas
+  como bytes de ancho fijo en lugar de objetos). load_shard los abre con
+  mmap_mode="r": no se copia nada y las lecturas salen de la caché de
+  páginas del sistema, así que las épocas repetidas no vuelven a
+  descomprimir ni cargan en RAM datos más grandes que la memoria.
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from src.conversor.board_representation import ENCODER_VERSION
+
+SHARD_SIZE = 65536
+MANIFEST_NAME = "manifest.json"
+SHARD_LAYOUTS = ("npz", "npy")
+UCI_DTYPE = "S5"  # Jugadas UCI en los shards "npy" (máximo 5 caracteres)
+
+# Claves del .npz que describen el archivo y no van por posición
+FILE_KEYS = ("format", "canonical", "planes")
+
+
+def load_manifest(shard_dir) -> dict:
+    """Manifiesto de `shard_dir` (vacío si todavía no hay ninguno)."""
+    path = Path(shard_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {"shard_size": SHARD_SIZE, "shards": []}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(shard_dir, manifest: dict):
+    """Escribe el manifiesto de forma atómica (archivo temporal + rename)."""
+    path = Path(shard_dir) / MANIFEST_NAME
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def manifest_sources(manifest: dict) -> set:
+    """Nombres de todos los archivos de origen ya repartidos (en algún shard o sin posiciones)."""
+    sources = {source for shard in manifest["shards"] for source in shard["sources"]}
+    return sources | set(manifest.get("empty_sources", []))
+
+
+def load_shard(path, mmap_mode: str = "r", allow_pickle: bool = False):
+    """
+    Abre un shard de cualquiera de los dos formatos (o un .npz de la ingesta).
+    Los "npy" se devuelven como diccionario de arrays mapeados en memoria
+    (`mmap_mode`); los .npz como el NpzFile de np.load. Los datos actuales
+    no llevan arrays de objetos: allow_pickle solo hace falta para leer
+    la `y` de .npz antiguos.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return np.load(path, allow_pickle=allow_pickle)
+    return {f.stem: np.load(f, mmap_mode=None if f.stem in FILE_KEYS else mmap_mode)
+            for f in sorted(path.glob("*.npy"))}
+
+
+def shard_bytes(path) -> int:
+    """Tamaño en disco de un shard (archivo .npz o carpeta de .npy)."""
+    path = Path(path)
+    return sum(f.stat().st_size for f in path.iterdir()) if path.is_dir() else path.stat().st_size
+
+
+def _save_npy_shard(path: Path, arrays: dict):
+    """Escribe un shard "npy" en una carpeta temporal y la renombra al final."""
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    for key, value in arrays.items():
+        if key == "y":
+            value = np.asarray(value).astype(UCI_DTYPE)
+        np.save(tmp / f"{key}.npy", np.ascontiguousarray(value), allow_pickle=False)
+    os.replace(tmp, path)
+
+
+def add_shard_weights(path, rows, extra):
+    """
+    Suma `extra` al peso ("weight") de las filas `rows` de un shard ya
+    escrito: los registros nuevos que repiten uno de un shard anterior
+    (dedup de todo el corpus). Los "npy" se modifican en su sitio con un
+    mmap; los .npz hay que reescribirlos enteros (temporal + rename).
+    """
+    path = Path(path)
+    if path.is_dir():
+        weights = np.load(path / "weight.npy", mmap_mode="r+")
+        np.add.at(weights, rows, np.asarray(extra, dtype=weights.dtype))
+        weights.flush()
+        return
+    with np.load(path, allow_pickle=True) as data:
+        arrays = {key: data[key] for key in data.files}
+    np.add.at(arrays["weight"], rows, np.asarray(extra, dtype=arrays["weight"].dtype))
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, path)
+
+
+def merge_arrays(chunks: list) -> dict:
+    """Concatena por posición varios diccionarios de arrays con el mismo formato."""
+    if len(chunks) == 1:
+        return dict(chunks[0])  # Sin copia: ShardWriter trocea partes grandes de shard en shard
+    merged = {}
+    for key in chunks[0]:
+        if key in FILE_KEYS:
+            merged[key] = chunks[0][key]
+        else:
+            merged[key] = np.concatenate([c[key] for c in chunks])
+    return merged
+
+
+class ShardWriter:
+    """
+    Acumula posiciones por tipo de partida y escribe un shard cada vez que
+    un tipo llega a `shard_size`. flush() escribe lo que quede (el último
+    shard de cada tipo puede ser más pequeño). El manifiesto se guarda tras
+    cada shard.
+
+    Uso:
+        writer = ShardWriter("data/processed", layout="npy")
+        writer.add(arrays, "blitz", "jugador_blitz.pgn")
+        writer.flush()
+    """
+
+    def __init__(self, shard_dir, shard_size: int = SHARD_SIZE, layout: str = "npz"):
+        if layout not in SHARD_LAYOUTS:
+            raise ValueError(f"Formato de shard desconocido: {layout!r} (opciones: {SHARD_LAYOUTS})")
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.layout = layout
+        self.manifest = load_manifest(self.shard_dir)
+        self._buffers = {}  # tipo → (lista de diccionarios, lista de (origen, posiciones))
+
+    def add(self, arrays: dict, perf_type: str, source: str):
+        """
+        Añade las posiciones de `arrays` (un .npz de la ingesta) procedentes
+        de `source`. Si no hay ninguna, `source` se anota en "empty_sources".
+        """
+        count = len(arrays["y"])
+        if count == 0:
+            empty = self.manifest.setdefault("empty_sources", [])
+            if source not in empty:
+                empty.append(source)
+                save_manifest(self.shard_dir, self.manifest)
+            return
+        chunks, sources = self._buffers.setdefault(perf_type, ([], []))
+        if chunks and any(not np.array_equal(chunks[0][k], arrays[k]) for k in FILE_KEYS if k in arrays):
+            raise ValueError(f"{source}: formato distinto del resto de posiciones de '{perf_type}'")
+        chunks.append(arrays)
+        sources.append((source, count))
+        while sum(n for _, n in sources) >= self.shard_size:
+            self._write(perf_type, self.shard_size)
+
+    def flush(self):
+        """Escribe los shards incompletos que queden en memoria."""
+        for perf_type, (_, sources) in list(self._buffers.items()):
+            if sources:
+                self._write(perf_type, sum(n for _, n in sources))
+
+    def _write(self, perf_type: str, count: int):
+        chunks, sources = self._buffers[perf_type]
+        merged = merge_arrays(chunks)
+        shard = {k: v if k in FILE_KEYS else v[:count] for k, v in merged.items()}
+        rest = {k: v if k in FILE_KEYS else v[count:] for k, v in merged.items()}
+
+        # Orígenes de las `count` primeras posiciones
+        shard_sources, taken = [], 0
+        while taken < count:
+            source, n = sources.pop(0)
+            used = min(n, count - taken)
+            shard_sources.append(source)
+            taken += used
+            if used < n:
+                sources.insert(0, (source, n - used))
+        chunks.clear()
+        if len(rest["y"]):
+            chunks.append(rest)
+
+        index = len(self.manifest["shards"])
+        if self.layout == "npy":
+            path = self.shard_dir / f"shard{index:05d}_{perf_type}"
+            _save_npy_shard(path, shard)
+        else:
+            path = self.shard_dir / f"shard{index:05d}_{perf_type}.npz"
+            np.savez_compressed(path, **shard)
+        self.manifest["shards"].append({
+            "path": path.name,
+            "layout": self.layout,
+            "count": int(count),
+            "unencodable": int((shard["policy"] < 0).sum()) if "policy" in shard else None,
+            "perf_type": perf_type,
+            "sources": shard_sources,
+            "encoder_version": ENCODER_VERSION,
+            "format": str(shard["format"]) if "format" in shard else "dense",
+            "canonical": bool(shard.get("canonical", False)),
+            "created": datetime.now().isoformat(timespec="seconds"),
+        })
+        save_manifest(self.shard_dir, self.manifest)
@@ -0,0 +1,110 @@
+# src/conversor/shm_ring.py
+"""
+Anillo de memoria compartida para pasar arrays entre procesos sin pickle.
+
+Un solo bloque de multiprocessing.shared_memory dividido en `num_slots`
+huecos de `slot_bytes`. Los huecos libres se reparten por una cola: el
+productor toma uno, copia los arrays dentro y manda por la cola del
+consumidor solo el número de hueco y la disposición (clave, dtype, forma,
+desplazamiento). El consumidor copia los arrays fuera y devuelve el hueco.
+
+Por las colas solo viajan unas decenas de bytes por hueco en lugar de los
+arrays, y el número de huecos limita cuánto puede adelantarse el productor
+al consumidor: si los consumidores no dan abasto, los productores esperan
+un hueco libre en vez de llenar la RAM.
+
+Uso:
+    ring = SharedRing(num_slots=8, slot_bytes=16 << 20)
+    # productor
+    for chunk in ring.split(arrays, fixed_keys=("format",)):
+        ring.put(chunk, meta, queue)
+    # consumidor
+    slot, layout, meta = queue.get()
+    arrays = ring.take(slot, layout)
+    ...
+    ring.close(unlink=True)  # en el proceso que lo creó
+"""
+
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_ALIGN = 64  # Cada array empieza alineado a 64 bytes dentro del hueco
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGN) * _ALIGN
+
+
+class SharedRing:
+    """
+    Huecos de tamaño fijo en memoria compartida con una cola de huecos libres.
+    Se puede pasar a procesos hijos (como argumento de mp.Process): se
+    vuelven a abrir por nombre.
+    """
+
+    def __init__(self, num_slots: int, slot_bytes: int, context=mp):
+        if num_slots <= 0 or slot_bytes <= 0:
+            raise ValueError("num_slots y slot_bytes deben ser mayores que 0")
+        self.num_slots = num_slots
+        self.slot_bytes = _aligned(slot_bytes)
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * self.slot_bytes)
+        self.free = context.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    def split(self, arrays: dict, fixed_keys=()):
+        """
+        Parte `arrays` por filas (posiciones) en trozos que caben en un hueco.
+        Las claves de `fixed_keys` describen el conjunto y van enteras en cada trozo.
+        """
+        rows = {key: value for key, value in arrays.items() if key not in fixed_keys}
+        fixed = {key: value for key, value in arrays.items() if key in fixed_keys}
+        n = len(next(iter(rows.values()))) if rows else 0
+        fixed_bytes = sum(_aligned(np.asarray(v).nbytes) for v in fixed.values())
+        row_bytes = sum(v[0].nbytes for v in rows.values()) if n else 0
+        # Margen de alineación: como mucho _ALIGN bytes de relleno por array
+        room = self.slot_bytes - fixed_bytes - _ALIGN * len(rows)
+        if n and room < row_bytes:
+            raise ValueError(f"Una posición ({row_bytes} bytes) no cabe en un hueco de {self.slot_bytes} bytes")
+        step = max(1, room // row_bytes) if n else 1
+        for start in range(0, max(n, 1), step):
+            yield dict(fixed, **{key: value[start:start + step] for key, value in rows.items()})
+
+    def put(self, arrays: dict, meta, queue) -> float:
+        """
+        Copia `arrays` en un hueco libre (espera si no hay) y manda (hueco,
+        disposición, meta) por `queue`. Devuelve los segundos de espera.
+        """
+        layout, offset = [], 0
+        for key, value in arrays.items():
+            value = np.asarray(value)
+            layout.append((key, value.dtype.str, value.shape, offset))
+            offset += _aligned(value.nbytes)
+        if offset > self.slot_bytes:
+            raise ValueError(f"Los arrays ({offset} bytes) no caben en un hueco de {self.slot_bytes} bytes")
+        wait_start = time.perf_counter()
+        slot = self.free.get()
+        waited = time.perf_counter() - wait_start
+        for (key, dtype, shape, start), value in zip(layout, arrays.values()):
+            self._view(slot, dtype, shape, start)[...] = value
+        queue.put((slot, layout, meta))
+        return waited
+
+    def take(self, slot: int, layout) -> dict:
+        """Copia fuera los arrays de un hueco recibido y lo devuelve a la cola de libres."""
+        try:
+            return {key: self._view(slot, dtype, shape, start).copy() for key, dtype, shape, start in layout}
+        finally:
+            self.free.put(slot)
+
+    def _view(self, slot: int, dtype, shape, start: int) -> np.ndarray:
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=slot * self.slot_bytes + start)
+
+    def close(self, unlink: bool = False):
+        """Cierra el bloque en este proceso; `unlink` lo libera (solo el proceso que lo creó)."""
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -0,0 +1,152 @@
+# src/conversor/stage_metrics.py
+"""
+Métricas por etapa de la ingesta (tiempos y contadores) en JSONL.
+
+Cada proceso (el principal y cada worker) añade una línea JSON por etapa
+terminada al mismo archivo: ejecución, pid, PGN o rango, etapa, segundos y
+contadores (partidas, posiciones, bytes de entrada y salida). Las líneas
+son cortas y se escriben de una vez en modo "a", así que los procesos no
+se pisan y no hace falta devolver nada a través del pool.
+
+Al terminar, el proceso principal lee las líneas de su ejecución y
+resume por etapa: tiempo total, ritmo (partidas/s, posiciones/s, MB/s) y
+la ocupación de los workers (tiempo medido en etapas / tiempo disponible).
+Las etapas de IDLE_STAGES son esperas (p. ej. a un hueco libre del anillo
+del pipeline): salen en la tabla pero no cuentan como ocupación.
+
+El identificador de la ejecución y la ruta del archivo van en variables
+de entorno para que los workers los hereden tanto con fork como con spawn.
+
+Uso:
+    run_id = start_run("logs/processing_metrics.jsonl")
+    with stage("encode", "jugador_blitz.pgn") as counters:
+        ...
+        counters["positions"] = n
+    summary = summarize(load_run(METRICS_PATH, run_id), wall_seconds, workers)
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+RUN_ID_ENV = "INGEST_RUN_ID"
+METRICS_PATH_ENV = "INGEST_METRICS_PATH"
+COUNTERS = ("games", "positions", "bytes_in", "bytes_out")
+IDLE_STAGES = ("ring_wait",)  # Esperas: no cuentan como tiempo ocupado
+
+
+def start_run(path) -> str:
+    """Empieza una ejecución: fija el archivo de métricas y un identificador nuevo."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    run_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+    os.environ[RUN_ID_ENV] = run_id
+    os.environ[METRICS_PATH_ENV] = str(path)
+    return run_id
+
+
+def _append(entry: dict):
+    """Escribe `entry` como una línea de la ejecución en marcha (si hay alguna)."""
+    run_id = os.environ.get(RUN_ID_ENV)
+    path = os.environ.get(METRICS_PATH_ENV)
+    if not run_id or not path:
+        return
+    line = json.dumps({"run": run_id, **entry}, ensure_ascii=False)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def record(stage_name: str, seconds: float, task: str = "", **counters):
+    """Añade una línea con la etapa terminada. Sin ejecución en marcha no hace nada."""
+    _append({
+        "pid": os.getpid(),
+        "time": datetime.now().isoformat(timespec="milliseconds"),
+        "task": task,
+        "stage": stage_name,
+        "seconds": round(seconds, 6),
+        **{key: int(value) for key, value in counters.items()},
+    })
+
+
+@contextmanager
+def stage(stage_name: str, task: str = "", **counters):
+    """
+    Mide el bloque como la etapa `stage_name`. Devuelve el diccionario de
+    contadores para completarlo dentro del bloque (p. ej. las posiciones).
+    """
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(stage_name, time.perf_counter() - start, task, **counters)
+
+
+def load_run(path, run_id: str) -> list:
+    """Registros de etapa de la ejecución `run_id`."""
+    path = Path(path)
+    if not path.exists():
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("run") == run_id and entry.get("stage") != "summary":
+                records.append(entry)
+    return records
+
+
+def summarize(records: list, wall_seconds: float, workers: int, main_pid: int = None) -> dict:
+    """
+    Totales por etapa (segundos, contadores y ritmos) y ocupación de los
+    workers: segundos medidos en los procesos distintos de `main_pid`
+    (sin las esperas de IDLE_STAGES) entre wall_seconds × workers.
+    """
+    stages = {}
+    busy = {}
+    for entry in records:
+        totals = stages.setdefault(entry["stage"], dict(seconds=0.0, calls=0, **{c: 0 for c in COUNTERS}))
+        totals["seconds"] += entry["seconds"]
+        totals["calls"] += 1
+        for counter in COUNTERS:
+            totals[counter] += entry.get(counter, 0)
+        if entry["pid"] != main_pid and entry["stage"] not in IDLE_STAGES:
+            busy[entry["pid"]] = busy.get(entry["pid"], 0.0) + entry["seconds"]
+    for totals in stages.values():
+        seconds = totals["seconds"]
+        totals["games_per_s"] = totals["games"] / seconds if seconds else 0.0
+        totals["positions_per_s"] = totals["positions"] / seconds if seconds else 0.0
+        totals["mb_in_per_s"] = totals["bytes_in"] / (1024 * 1024) / seconds if seconds else 0.0
+    available = wall_seconds * max(1, workers)
+    return {
+        "wall_seconds": wall_seconds,
+        "workers": workers,
+        "worker_processes": len(busy),
+        "utilisation": sum(busy.values()) / available if available else 0.0,
+        "stages": stages,
+    }
+
+
+def save_summary(summary: dict):
+    """Añade el resumen de la ejecución como una línea más (etapa "summary")."""
+    _append({"stage": "summary", **summary})
+
+
+def format_summary(summary: dict) -> list:
+    """Tabla de texto (una línea por etapa) para el log."""
+    total = sum(s["seconds"] for s in summary["stages"].values()) or 1.0
+    lines = [f"{'Etapa':<12} {'Tiempo (s)':>11} {'%':>6} {'Partidas/s':>11} {'Posic./s':>11} "
+             f"{'MB entrada':>11} {'MB salida':>10}"]
+    for name, s in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(f"{name:<12} {s['seconds']:>11,.2f} {s['seconds'] / total:>6.1%} {s['games_per_s']:>11,.1f} "
+                     f"{s['positions_per_s']:>11,.0f} {s['bytes_in'] / (1024 * 1024):>11,.2f} "
+                     f"{s['bytes_out'] / (1024 * 1024):>10,.2f}")
+    lines.append(f"Ocupación de los workers: {summary['utilisation']:.1%} "
+                 f"({summary['worker_processes']} procesos, {summary['workers']} plazas, "
+                 f"{summary['wall_seconds']:,.1f} s)")
+    return lines
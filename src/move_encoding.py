@@ -1,7 +1,10 @@
 # src/move_encoding.py
 
+from collections import OrderedDict
+
 import numpy as np
 import chess
+import chess.polyglot
 from typing import List, Dict
 
 # === CONFIGURACIÓN DEL ESPACIO DE MOVIMIENTOS (8x8x73) ===
@@ -111,11 +114,62 @@ def _generate_move_mapping():
 
 _generate_move_mapping()
 
+# === Tablas precalculadas para codificar arrays enteros de una vez ===
+# Código de coronación = tipo de pieza de python-chess (0 = sin coronación)
+NUM_PROMO_CODES = 7
+_PROMO_PLANE_PIECES = (chess.QUEEN, chess.ROOK, chess.BISHOP)  # promo 0, 1, 2 de los planos 64-72
+_PROMO_CHAR_CODES = np.zeros(256, dtype=np.int8)
+_PROMO_CHAR_CODES[[ord('n'), ord('b'), ord('r'), ord('q')]] = [chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+
+
+def _build_index_tables():
+    """
+    MOVE_INDEX_TABLE[from, to, promo] → índice (-1 si no es codificable), y
+    las inversas índice → from, to, promo y UCI. Salen de INDEX_TO_MOVE, así
+    que dan lo mismo que uci_to_flat_index / flat_index_to_uci.
+    """
+    table = np.full((64, 64, NUM_PROMO_CODES), -1, dtype=np.int16)
+    from_sq = np.full(TOTAL_MOVES, -1, dtype=np.int8)
+    to_sq = np.full(TOTAL_MOVES, -1, dtype=np.int8)
+    promo = np.zeros(TOTAL_MOVES, dtype=np.int8)
+    for index, (fr, to) in INDEX_TO_MOVE.items():
+        plane = index % 73
+        piece = _PROMO_PLANE_PIECES[(plane - 64) % 3] if plane >= 64 else 0
+        table[fr, to, piece] = index
+        from_sq[index], to_sq[index], promo[index] = fr, to, piece
+    return table, from_sq, to_sq, promo
+
+
+MOVE_INDEX_TABLE, INDEX_FROM_SQUARE, INDEX_TO_SQUARE, INDEX_PROMOTION = _build_index_tables()
+
+# === Modo canónico (el lado que mueve siempre juega "con blancas") ===
+def mirror_move(move: chess.Move) -> chess.Move:
+    """Refleja un movimiento verticalmente (e7e8q ↔ e2e1q), como board.mirror()."""
+    return chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square),
+                      promotion=move.promotion, drop=move.drop)
+
+
+def mirror_uci(uci: str) -> str:
+    """Versión UCI de mirror_move."""
+    return mirror_move(chess.Move.from_uci(uci)).uci()
+
+
+def canonical_uci(uci: str, turn: chess.Color) -> str:
+    """Movimiento visto desde el lado que mueve: se refleja si mueven las negras."""
+    return mirror_uci(uci) if turn == chess.BLACK else uci
+
+
 # === API pública ===
-def uci_to_flat_index(uci: str) -> int:
-    """Convierte UCI a índice en [0, 4671]. Devuelve -1 si inválido."""
+def uci_to_flat_index(uci: str, mirror: bool = False) -> int:
+    """
+    Convierte UCI a índice en [0, 4671]. Devuelve -1 si inválido.
+    Con mirror=True el movimiento se refleja antes (modo canónico para una
+    posición con negras al turno); así las coronaciones negras también caben.
+    """
     try:
         move = chess.Move.from_uci(uci)
+        if mirror:
+            move = mirror_move(move)
         from_sq = move.from_square
         to_sq = move.to_square
         fr, fc = from_sq // 8, from_sq % 8
@@ -154,8 +208,11 @@ def uci_to_flat_index(uci: str) -> int:
     except Exception:
         return -1
 
-def flat_index_to_uci(index: int) -> str:
-    """Convierte índice [0,4671] a UCI."""
+def flat_index_to_uci(index: int, mirror: bool = False) -> str:
+    """
+    Convierte índice [0,4671] a UCI.
+    Con mirror=True deshace el modo canónico (posición con negras al turno).
+    """
     if index < 0 or index >= 4672:
         return ""
     if index not in INDEX_TO_MOVE:
@@ -169,15 +226,216 @@ def flat_index_to_uci(index: int) -> str:
         promo_map = {0: 'q', 1: 'r', 2: 'b'}
         promo_idx = (plane - (56 + 8)) % 3
         uci += promo_map[promo_idx]
-    return uci
+    return mirror_uci(uci) if mirror else uci
+
+def moves_to_indices(from_squares, to_squares, promotions=None, mirror=False) -> np.ndarray:
+    """
+    Versión vectorizada de uci_to_flat_index para arrays de casillas.
+
+    Args:
+        from_squares, to_squares: arrays de enteros 0-63.
+        promotions: tipo de pieza coronada (chess.QUEEN...) o 0; None = sin coronaciones.
+        mirror: bool, o array de bool por posición (modo canónico con negras al turno).
+
+    Returns:
+        np.ndarray int16 con los índices; -1 donde el movimiento no es codificable.
+    """
+    from_squares = np.asarray(from_squares, dtype=np.int64)
+    to_squares = np.asarray(to_squares, dtype=np.int64)
+    promotions = np.zeros_like(from_squares) if promotions is None else np.asarray(promotions, dtype=np.int64)
+    flip = np.where(np.asarray(mirror, dtype=bool), 56, 0)
+    ok = ((from_squares >= 0) & (from_squares < 64) & (to_squares >= 0) & (to_squares < 64)
+          & (promotions >= 0) & (promotions < NUM_PROMO_CODES))
+    indices = MOVE_INDEX_TABLE[(from_squares ^ flip) & 63, (to_squares ^ flip) & 63, promotions % NUM_PROMO_CODES]
+    return np.where(ok, indices, -1).astype(np.int16)
+
+
+def uci_array_to_squares(ucis):
+    """
+    Array de cadenas UCI → (from, to, promo) como arrays int8, con promo el
+    tipo de pieza coronada o 0 (-1, -1, 0 si la cadena no es una jugada).
+    """
+    raw = np.asarray(ucis).astype('S6')
+    chars = raw.view(np.uint8).reshape(len(raw), 6).astype(np.int64)
+    files = chars[:, [0, 2]] - ord('a')
+    ranks = chars[:, [1, 3]] - ord('1')
+    promo_char = chars[:, 4]
+    ok = (((files >= 0) & (files < 8) & (ranks >= 0) & (ranks < 8)).all(axis=1)
+          & (chars[:, 5] == 0) & ((promo_char == 0) | (_PROMO_CHAR_CODES[promo_char] > 0)))
+    squares = np.where(ok[:, None], ranks * 8 + files, -1).astype(np.int8)
+    return squares[:, 0], squares[:, 1], np.where(ok, _PROMO_CHAR_CODES[promo_char], 0).astype(np.int8)
+
+
+def uci_array_to_indices(ucis, mirror=False) -> np.ndarray:
+    """
+    Versión vectorizada de uci_to_flat_index: array de cadenas UCI → int16
+    (-1 si la jugada es inválida o no codificable). `mirror` como en moves_to_indices.
+    """
+    return moves_to_indices(*uci_array_to_squares(ucis), mirror=mirror)
+
+
+# === Jugadas compactas: from | to << 6 | promo << 12 en un uint16 ===
+INVALID_MOVE_CODE = 0xFFFF
+
+
+def pack_moves(from_squares, to_squares, promotions) -> np.ndarray:
+    """(from, to, promo) → uint16; INVALID_MOVE_CODE donde from o to es -1."""
+    from_squares = np.asarray(from_squares, dtype=np.int64)
+    to_squares = np.asarray(to_squares, dtype=np.int64)
+    codes = from_squares | to_squares << 6 | np.asarray(promotions, dtype=np.int64) << 12
+    return np.where((from_squares >= 0) & (to_squares >= 0), codes, INVALID_MOVE_CODE).astype(np.uint16)
+
+
+def unpack_moves(codes):
+    """Inversa de pack_moves: uint16 → (from, to, promo) int8 (-1, -1, 0 si inválido)."""
+    codes = np.asarray(codes, dtype=np.int64)
+    ok = codes != INVALID_MOVE_CODE
+    from_sq = np.where(ok, codes & 63, -1).astype(np.int8)
+    to_sq = np.where(ok, codes >> 6 & 63, -1).astype(np.int8)
+    return from_sq, to_sq, np.where(ok, codes >> 12, 0).astype(np.int8)
+
+
+def indices_to_moves(indices, mirror=False):
+    """
+    Inversa vectorizada: índices → (from, to, promo) como arrays int8
+    (-1, -1, 0 para índices inválidos). `mirror` deshace el modo canónico.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    ok = (indices >= 0) & (indices < TOTAL_MOVES)
+    safe = np.where(ok, indices, 0)
+    from_sq, to_sq, promo = INDEX_FROM_SQUARE[safe], INDEX_TO_SQUARE[safe], INDEX_PROMOTION[safe]
+    ok &= from_sq >= 0
+    flip = np.where(np.asarray(mirror, dtype=bool), 56, 0)
+    from_sq = np.where(ok, from_sq ^ flip, -1).astype(np.int8)
+    to_sq = np.where(ok, to_sq ^ flip, -1).astype(np.int8)
+    return from_sq, to_sq, np.where(ok, promo, 0).astype(np.int8)
+
+
+def indices_to_uci(indices, mirror=False) -> np.ndarray:
+    """Versión vectorizada de flat_index_to_uci: array de índices → array de UCI ("" si inválido)."""
+    from_sq, to_sq, promo = indices_to_moves(indices, mirror)
+    ok = from_sq >= 0
+    names = np.array(chess.SQUARE_NAMES + [""])
+    symbols = np.array(["", "", "n", "b", "r", "q", ""])
+    return np.where(ok, np.char.add(np.char.add(names[from_sq], names[to_sq]), symbols[promo]), "")
+
+
+# === Máscara de jugadas legales ===
+LEGAL_CACHE_SIZE = 50000  # Posiciones cuyas jugadas legales se guardan (solo índices, ~60 bytes cada una)
+_legal_cache = OrderedDict()
+
+
+def legal_move_indices(board: chess.Board, mirror: bool = False) -> np.ndarray:
+    """
+    Índices (int16) de las jugadas legales de `board` en el espacio de 4672.
+    Las que no tienen índice (coronación a caballo) se omiten. Con
+    mirror=True se usan los índices del modo canónico (negras al turno).
+    Se cachea por hash Zobrist, que ya incluye turno, enroques y al paso.
+    """
+    key = (chess.polyglot.zobrist_hash(board), bool(mirror))
+    indices = _legal_cache.get(key)
+    if indices is not None:
+        _legal_cache.move_to_end(key)
+        return indices
+    moves = [(m.from_square, m.to_square, m.promotion or 0) for m in board.legal_moves]
+    if moves:
+        from_sq, to_sq, promo = np.array(moves, dtype=np.int64).T
+        indices = moves_to_indices(from_sq, to_sq, promo, mirror)
+        indices = indices[indices >= 0]
+    else:
+        indices = np.empty(0, dtype=np.int16)
+    _legal_cache[key] = indices
+    if len(_legal_cache) > LEGAL_CACHE_SIZE:
+        _legal_cache.popitem(last=False)
+    return indices
+
+
+def legal_move_mask(board: chess.Board, mirror: bool = False) -> np.ndarray:
+    """Máscara booleana (4672,) con True en las jugadas legales de `board`."""
+    mask = np.zeros(TOTAL_MOVES, dtype=bool)
+    mask[legal_move_indices(board, mirror)] = True
+    return mask
+
+
+def legal_move_masks(boards, mirror=False, out: np.ndarray = None) -> np.ndarray:
+    """
+    Versión por lotes de legal_move_mask: (N, 4672) bool.
+    `mirror` puede ser un bool o uno por tablero; `out` un buffer (>= N, 4672).
+    """
+    n = len(boards)
+    flips = np.broadcast_to(np.asarray(mirror, dtype=bool), (n,))
+    if out is None:
+        out = np.zeros((n, TOTAL_MOVES), dtype=bool)
+    elif out.shape[0] < n or out.shape[1:] != (TOTAL_MOVES,):
+        raise ValueError(f"out debe tener forma (>= {n}, {TOTAL_MOVES}), tiene {out.shape}")
+    else:
+        out[:n] = False
+    for i, board in enumerate(boards):
+        out[i, legal_move_indices(board, flips[i])] = True
+    return out[:n]
+
+
+def clear_legal_cache():
+    _legal_cache.clear()
+
+
+def top_k_legal_moves(policy, boards, k: int = 5, mirror=False, logits: bool = False):
+    """
+    Decodifica por lotes la salida (N, 4672) del modelo: las k mejores jugadas
+    legales de cada tablero y sus probabilidades renormalizadas entre las
+    legales. Usa np.argpartition, no ordena las 4672 entradas.
+
+    Args:
+        policy: probabilidades (salida softmax) o logits si logits=True.
+        boards: los N tableros de cada fila.
+        k: jugadas por fila.
+        mirror: bool o uno por tablero (modelo entrenado en modo canónico).
+
+    Returns:
+        (moves, probs): arrays (N, k) de UCI y float32, de mejor a peor.
+        Si un tablero tiene menos de k jugadas legales el resto queda "" y 0.
+    """
+    policy = np.asarray(policy, dtype=np.float32).reshape(len(boards), TOTAL_MOVES)
+    flips = np.broadcast_to(np.asarray(mirror, dtype=bool), (len(boards),))
+    mask = legal_move_masks(boards, flips)
+    k = min(k, TOTAL_MOVES)
+
+    if logits:
+        scores = np.where(mask, policy, -np.inf)
+        peak = scores.max(axis=1, keepdims=True)
+        probs = np.exp(scores - np.where(np.isfinite(peak), peak, 0))
+    else:
+        probs = np.where(mask, policy, 0)
+    total = probs.sum(axis=1, keepdims=True)
+    # Si el modelo no da masa a ninguna legal, se reparte por igual entre ellas
+    probs = np.where(total > 0, probs / np.where(total > 0, total, 1), mask / np.maximum(mask.sum(axis=1, keepdims=True), 1))
+
+    top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    top_probs = np.take_along_axis(probs, top, axis=1)
+    order = np.argsort(-top_probs, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_probs = np.take_along_axis(top_probs, order, axis=1)
+
+    legal = np.take_along_axis(mask, top, axis=1)
+    moves = indices_to_uci(top, flips[:, None])
+    return np.where(legal, moves, ""), np.where(legal, top_probs, 0).astype(np.float32)
+
 
 def encode_moves_4672(moves: List[str]) -> np.ndarray:
-    indices = [uci_to_flat_index(m) for m in moves]
-    indices = [i if i != -1 else 0 for i in indices]
-    return np.eye(4672)[indices]
+    """
+    Etiquetas de política como índices de clase (int16, 2 bytes por jugada)
+    para pérdidas sparse; las jugadas no codificables van al índice 0.
+    """
+    indices = uci_array_to_indices(moves)
+    indices[indices == -1] = 0
+    return indices
+
+def decode_move_4672(index: int, mirror: bool = False) -> str:
+    return flat_index_to_uci(index, mirror)
 
-def decode_move_4672(index: int) -> str:
-    return flat_index_to_uci(index)
+def encode_moves(moves: List[str], vocab: Dict[str, int]) -> np.ndarray:
+    """Índices de clase según `vocab` (ver create_move_vocab); -1 si la jugada no está."""
+    return np.array([vocab.get(str(m), -1) for m in moves], dtype=np.int32)
 
 def create_move_vocab(moves: List[str], min_freq=1) -> Dict[str, int]:
     from collections import Counter
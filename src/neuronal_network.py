@@ -69,7 +69,7 @@ def create_chess_network(input_shape=(8, 8, 22), num_policies=None, num_residual
     model.compile(
         optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
         loss={
-        'policy': 'categorical_crossentropy',
+        'policy': 'sparse_categorical_crossentropy',  # Etiquetas como índices de clase
         'value': 'mean_squared_error' 
         },
         loss_weights={
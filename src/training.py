@@ -53,7 +53,7 @@ def train_supervised(
 
     # --- 3. Preparar etiquetas ---
     print("🎯 Preparando etiquetas...")
-    y_policy = tf.keras.utils.to_categorical(y_idx, num_classes=num_policies)
+    y_policy = y_idx  # Índices de clase: la pérdida es sparse, sin one-hot
     y_value = np.zeros(len(X), dtype=np.float32)  # Temporal: valor del estado
 
     # --- 4. Crear modelo ---
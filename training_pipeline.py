@@ -7,7 +7,12 @@ import logging
 from datetime import datetime
 import csv
 import psutil
-from src.move_encoding import uci_to_flat_index
+from src.move_encoding import uci_array_to_indices
+from src.conversor.plane_packing import (
+    PACKED_KEYS, is_packed, num_positions, bitboard_bytes, tf_unpack_planes, convert_planes, tf_convert_planes
+)
+from src.conversor.board_representation import FEATURE_SETS, ENCODER_VERSION, resolve_feature_set
+from src.conversor.shards import load_manifest, load_shard, shard_bytes
 from models.chess_policy_model import create_policy_model
 # === CONFIGURACIÓN ===
 PROCESSED_DATA_DIR = "data/processed"
@@ -17,6 +22,16 @@ PROCESSED_LOG_FILE = "logs/processed_files.txt"
 METRICS_CSV = "logs/training_metrics.csv"
 LOG_FILE = "logs/training.log"
 FILTER_PERF_TYPES = ["blitz", "bullet", "rapid", "classical"]
+FEATURE_SET = "full-29"             # Planos de entrada del modelo ("full-29", "core-22", "cheap-25" o lista)
+FEATURE_PLANES = resolve_feature_set(FEATURE_SET)
+INPUT_DTYPE = "float32"             # Tipo de los lotes de entrada: "float32", "float16" o "uint8" (cuantizado)
+CANONICAL = False                   # Datos codificados desde el lado que mueve (CANONICAL de la ingesta)
+USE_SAMPLE_WEIGHTS = True           # Usar el peso de las posiciones deduplicadas (DEDUP de la ingesta) como sample_weight
+# Las repeticiones en bruto van de 1 a 10⁴-10⁵ (aperturas, posición inicial): como sample_weight
+# disparan el gradiente y desbordan la escala de pérdida de mixed_float16. Se comprimen con
+# "log" (1 + ln n) o "sqrt" (√n), o "count" para usarlas tal cual, y se normalizan a media 1
+# en cada shard para que la escala de la pérdida no dependa de cuánto se repita el shard.
+SAMPLE_WEIGHT_MODE = "log"
 BATCH_SIZE = 128                    # Aumentado: aprovecha VRAM
 EPOCHS = 1                          # Por archivo
 GLOBAL_EPOCHS = 2                   # Pasar 2 veces por todos los archivos
@@ -50,8 +65,13 @@ def discover_files(data_dir, perf_types_filter=None):
     data_dir = Path(data_dir)
     if not data_dir.exists():
         raise FileNotFoundError(f"Directorio no encontrado: {data_dir}")
-    all_files = list(data_dir.glob("*.npz"))
-    logger.info(f"🔍 Descubiertos {len(all_files)} archivos .npz")
+    shards = manifest_shards(data_dir)
+    if shards:
+        all_files = list(shards)
+        logger.info(f"🔍 Manifiesto: {len(all_files)} shards")
+    else:
+        all_files = list(data_dir.glob("*.npz"))
+        logger.info(f"🔍 Descubiertos {len(all_files)} archivos .npz")
 
     processed_files = set()
     if Path(PROCESSED_LOG_FILE).exists():
@@ -76,36 +96,119 @@ def discover_files(data_dir, perf_types_filter=None):
     return filtered_files
 
 
+def manifest_shards(data_dir) -> dict:
+    """
+    Shards del manifiesto de la ingesta → número de posiciones, sin abrirlos.
+    Se omiten los de otra versión del codificador.
+    """
+    shards = {}
+    for shard in load_manifest(data_dir)["shards"]:
+        if shard["encoder_version"] != ENCODER_VERSION:
+            logger.warning(f"⚠️  {shard['path']}: codificador {shard['encoder_version']}, se esperaba {ENCODER_VERSION}")
+            continue
+        shards[Path(data_dir) / shard["path"]] = shard["count"]
+    return shards
+
+
 # === 2. Crear dataset seguro (sin from_generator frágil) ===
+def plane_selector(data):
+    """
+    Posiciones de FEATURE_PLANES dentro de los planos guardados en el archivo,
+    o None si el archivo ya trae exactamente esos planos.
+    """
+    stored = tuple(int(p) for p in data["planes"]) if "planes" in data else FEATURE_SETS["full-29"]
+    if stored == FEATURE_PLANES:
+        return None
+    missing = [p for p in FEATURE_PLANES if p not in stored]
+    if missing:
+        raise ValueError(f"El archivo no contiene los planos {missing} de {FEATURE_SET}")
+    return [stored.index(p) for p in FEATURE_PLANES]
+
+
+def check_canonical(data):
+    """
+    Comprueba que el archivo se codificó en el mismo modo que CANONICAL: en
+    modo canónico las jugadas ya vienen reflejadas y no se pueden mezclar.
+    """
+    stored = bool(data["canonical"]) if "canonical" in data else False
+    if stored != CANONICAL:
+        raise ValueError(f"El archivo tiene canonical={stored} y el entrenamiento usa CANONICAL={CANONICAL}")
+
+
+def sample_weights(counts, valid) -> np.ndarray:
+    """
+    sample_weight (float32) de todos los registros a partir de sus
+    repeticiones, según SAMPLE_WEIGHT_MODE y con media 1 sobre los `valid`.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if SAMPLE_WEIGHT_MODE == "log":
+        weights = 1.0 + np.log(np.maximum(counts, 1.0))
+    elif SAMPLE_WEIGHT_MODE == "sqrt":
+        weights = np.sqrt(counts)
+    elif SAMPLE_WEIGHT_MODE == "count":
+        weights = counts
+    else:
+        raise ValueError(f"SAMPLE_WEIGHT_MODE desconocido: {SAMPLE_WEIGHT_MODE!r} (opciones: log, sqrt, count)")
+    mean = weights[valid].mean() if len(valid) else 1.0
+    return (weights / mean).astype(np.float32)
+
+
 def create_dataset_from_file(file_path, batch_size):
     """
-    Carga un archivo .npz y crea un dataset eficiente.
-    No sobrecarga RAM: solo carga este archivo.
+    Carga un archivo .npz (o un shard "npy") y crea un dataset eficiente.
+    No sobrecarga RAM: solo carga este archivo, y los shards "npy" ni eso:
+    se leen por lotes desde el archivo mapeado en memoria.
     """
     try:
-        data = np.load(file_path, allow_pickle=True)
-        X, moves = data["X"], data["y"]
-
-        # Codificar movimientos válidos
-        X_list, y_list = [], []
-        for board, move in zip(X, moves):
-            idx = uci_to_flat_index(str(move))
-            if idx == -1:
-                continue
-            X_list.append(board)
-            y_list.append(idx)
-
-        if len(y_list) == 0:
+        data = load_shard(file_path)
+        check_canonical(data)
+
+        # Índices de política guardados en la ingesta. Los .npz anteriores solo
+        # traen las jugadas UCI como objetos: se codifican aquí (tabla
+        # precalculada, todo el archivo de una vez)
+        if "policy" in data:
+            indices = np.asarray(data["policy"])
+        else:
+            moves = data["y"] if isinstance(data, dict) else load_shard(file_path, allow_pickle=True)["y"]
+            indices = uci_array_to_indices(moves)
+        valid = np.flatnonzero(indices >= 0)
+        y_array = indices[valid].astype(np.int32)
+
+        if len(y_array) == 0:
             logger.warning(f"⚠️  Sin movimientos válidos en {file_path}")
             return None
-
-        X_array = np.array(X_list, dtype=np.float32)
-        y_array = np.array(y_list, dtype=np.int32)
-
-        dataset = tf.data.Dataset.from_tensor_slices((X_array, y_array))
+        selector = plane_selector(data)
+        # Posiciones deduplicadas: cada registro pesa según cuántas veces apareció (ver SAMPLE_WEIGHT_MODE)
+        weights = sample_weights(data["weight"], valid) if USE_SAMPLE_WEIGHTS and "weight" in data else None
+
+        if isinstance(data, dict):
+            return _mapped_dataset(data, indices.astype(np.int32), valid, batch_size, selector, weights)
+
+        targets = (y_array,) if weights is None else (y_array, weights[valid])
+        if is_packed(data):
+            # Formato compacto: se expande a (B, 8, 8, 29) por lote en el map()
+            packed = {key: data[key][valid] for key in PACKED_KEYS}
+            features = (bitboard_bytes(packed["bitboards"]), packed["flags"], packed["scalars"],
+                        packed["attacks"], packed["mobility"])
+            dataset = tf.data.Dataset.from_tensor_slices((features,) + targets)
+            return (
+                dataset
+                .shuffle(min(SHUFFLE_BUFFER, len(y_array)))
+                .batch(batch_size)
+                .map(lambda x, *target: (_to_input(_select_planes(tf_unpack_planes(*x), selector)), *target),
+                     num_parallel_calls=tf.data.AUTOTUNE)
+                .prefetch(tf.data.AUTOTUNE)
+            )
+
+        X_array = data["X"][valid]
+        if selector is not None:
+            X_array = X_array[..., selector]
+        X_array = convert_planes(X_array, INPUT_DTYPE, FEATURE_PLANES)
+
+        dataset = tf.data.Dataset.from_tensor_slices((X_array,) + targets)
         return (
             dataset
-            .shuffle(min(SHUFFLE_BUFFER, len(y_list)))
+            .shuffle(min(SHUFFLE_BUFFER, len(y_array)))
             .batch(batch_size)
             .prefetch(tf.data.AUTOTUNE)
         )
@@ -115,6 +218,61 @@ def create_dataset_from_file(file_path, batch_size):
         return None
 
 
+def _mapped_dataset(data, labels, valid, batch_size, selector, weights=None):
+    """
+    Dataset sobre un shard "npy" mapeado en memoria: solo se barajan los
+    índices de las posiciones, y cada lote se copia del mapa (de la caché
+    de páginas tras la primera época) con índices ordenados. Con `weights`
+    cada lote lleva también los sample_weight (float32).
+    """
+    packed = is_packed(data)
+    arrays = [data[key] for key in PACKED_KEYS] if packed else [data["X"]]
+    num_inputs = len(arrays)
+    arrays.append(labels)
+    if weights is not None:
+        arrays.append(weights)
+
+    def gather(idx):
+        idx = np.sort(idx)
+        batch = [np.ascontiguousarray(a[idx]) for a in arrays]
+        if packed:
+            batch[0] = bitboard_bytes(batch[0])
+        else:
+            x = batch[0] if selector is None else batch[0][..., selector]
+            batch[0] = convert_planes(x, INPUT_DTYPE, FEATURE_PLANES)
+        return tuple(batch)
+
+    shapes = [(None,) + a.shape[1:] for a in arrays]
+    dtypes = [tf.as_dtype(a.dtype) for a in arrays]
+    if packed:
+        shapes[0], dtypes[0] = (None,) + bitboard_bytes(arrays[0][:1]).shape[1:], tf.uint8
+    else:
+        shapes[0], dtypes[0] = (None, 8, 8, len(FEATURE_PLANES)), tf.as_dtype(INPUT_DTYPE)
+
+    def load(idx):
+        batch = tf.numpy_function(gather, [idx], dtypes)
+        for tensor, shape in zip(batch, shapes):
+            tensor.set_shape(shape)
+        x = _to_input(_select_planes(tf_unpack_planes(*batch[:num_inputs]), selector)) if packed else batch[0]
+        return (x, *batch[num_inputs:])
+
+    return (
+        tf.data.Dataset.from_tensor_slices(valid)
+        .shuffle(len(valid))
+        .batch(batch_size)
+        .map(load, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+
+def _select_planes(x, selector):
+    return x if selector is None else tf.gather(x, selector, axis=-1)
+
+
+def _to_input(x):
+    return x if INPUT_DTYPE == "float32" else tf_convert_planes(x, INPUT_DTYPE, FEATURE_PLANES)
+
+
 def perf_type_from_filename(file_path):
     stem = file_path.stem.lower()
     return stem.rsplit("_", 1)[1] if "_" in stem else "desconocido"
@@ -139,7 +297,7 @@ def init_metrics_csv():
 
 
 def log_metrics_to_csv(global_step, epoch, global_epoch, file_index, logs, file_path, pos_count):
-    file_size = file_path.stat().st_size / (1024 * 1024)
+    file_size = shard_bytes(file_path) / (1024 * 1024)
     perf_type = perf_type_from_filename(file_path)
     with open(METRICS_CSV, "a", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
@@ -208,6 +366,7 @@ def main():
         init_metrics_csv()
 
     file_paths = discover_files(PROCESSED_PATH, FILTER_PERF_TYPES)
+    shard_counts = manifest_shards(PROCESSED_PATH)
     if not file_paths:
         logger.info("✅ No hay nuevos archivos para procesar.")
         return
@@ -222,7 +381,7 @@ def main():
         )
     else:
         logger.info("🆕 Creando nuevo modelo...")
-        model = create_policy_model(input_shape=(8, 8, 29))
+        model = create_policy_model(feature_set=FEATURE_PLANES, input_dtype=INPUT_DTYPE)
 
     # === Optimizador con escalado ===
     optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE)
@@ -247,11 +406,14 @@ def main():
             logger.info(f"📦 [{idx+1}/{len(file_paths)}] Procesando: {file_path.name}")
 
             try:
-                data = np.load(file_path, allow_pickle=True)
-                if "X" not in data or "y" not in data:
-                    logger.error(f"❌ {file_path}: faltan 'X' o 'y'")
-                    continue
-                n_samples = len(data["X"])
+                if file_path in shard_counts:
+                    n_samples = shard_counts[file_path]  # del manifiesto, sin abrir el shard
+                else:
+                    data = load_shard(file_path)
+                    if ("X" not in data and not is_packed(data)) or "y" not in data:
+                        logger.error(f"❌ {file_path}: faltan 'X' o 'y'")
+                        continue
+                    n_samples = num_positions(data)
                 if n_samples == 0:
                     logger.error(f"❌ {file_path}: Sin muestras")
                     continue
@@ -270,7 +432,7 @@ def main():
             # Diagnóstico
             try:
                 for batch in dataset.take(1):
-                    x, y = batch
+                    x, y = batch[:2]  # (x, y) o (x, y, sample_weight)
                     logger.info(f"🔧 Batch OK: entrada {x.shape}, etiqueta {y.shape}, ej: {y[0].numpy()}")
                     break
                 else: